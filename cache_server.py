@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# A minimal server for make.py's --remote-cache: stores manifests under /ac/<key> and file contents under
+# /cas/<digest> in a directory, with the same layout as a local --cache-dir (but JSON manifests). There's no
+# authentication or eviction, so only run it on a trusted network, and clean out the directory as needed.
+import hashlib
+import http.server
+import os
+import re
+import threading
+from optparse import OptionParser
+
+path_re = re.compile('^/(ac|cas)/([0-9a-f]{40})$')
+
+class CacheHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep connections alive between requests
+
+    def get_path(self):
+        m = path_re.match(self.path)
+        if not m:
+            self.close_connection = True # there may be a request body we aren't going to read
+            self.send_error(404)
+            return None
+        (kind, key) = m.groups()
+        return (kind, key, '%s/%s/%s/%s' % (self.server.dir, kind, key[:2], key))
+
+    def send_file(self, head):
+        path_info = self.get_path()
+        if path_info is None:
+            return
+        try:
+            with open(path_info[2], 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json' if path_info[0] == 'ac' else 'application/octet-stream')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if not head:
+            self.wfile.write(data)
+
+    def do_GET(self):
+        self.send_file(False)
+
+    def do_HEAD(self):
+        self.send_file(True)
+
+    def do_PUT(self):
+        path_info = self.get_path()
+        if path_info is None:
+            return
+        (kind, key, path) = path_info
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        # Files are stored by digest, so we can check that they arrived intact
+        if kind == 'cas' and hashlib.blake2b(data, digest_size=20).hexdigest() != key:
+            self.send_error(400, 'digest mismatch')
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '%s.%d.tmp' % (path, threading.get_ident())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self.send_response(201)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            http.server.BaseHTTPRequestHandler.log_message(self, format, *args)
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--host', dest='host', type='str', default='localhost',
+            help='address to listen on (default: localhost; use 0.0.0.0 to serve a LAN)')
+    parser.add_option('--port', dest='port', type='int', default=8765, help='port to listen on (default: 8765)')
+    parser.add_option('--dir', dest='dir', type='str', default='make_py_cache',
+            help='directory to store the cache in (default: make_py_cache)', metavar='DIR')
+    parser.add_option('-v', dest='verbose', action='store_true', help='log every request')
+    (options, args) = parser.parse_args()
+    assert not args
+
+    server = http.server.ThreadingHTTPServer((options.host, options.port), CacheHandler)
+    server.dir = os.path.abspath(options.dir)
+    server.verbose = options.verbose
+    print('Serving a make.py remote cache from %s on http://%s:%d/' % (server.dir, options.host, options.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 import json
 import os
-import pipes
+import shlex
 from optparse import OptionParser
 
 import make
@@ -46,7 +46,7 @@ def rule_to_makefile(fp, rule):
     if target_dirs:
         # Create target directories
         cmd_list.insert(0, ['mkdir', '-p'] + list(target_dirs))
-    cmds = '\n\t'.join([' '.join([pipes.quote(arg) for arg in cmd]) for cmd in cmd_list])
+    cmds = '\n\t'.join([' '.join([shlex.quote(arg) for arg in cmd]) for cmd in cmd_list])
     # recipe
     fp.write('%s: %s\n\t%s\n\n' % (targets, deps, cmds))
     # d_file
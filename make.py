@@ -19,75 +19,315 @@
 # DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT
 # OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
+# Only what a build that has nothing to do needs is imported up front; everything else (subprocess, pickle, asyncio,
+# the remote cache's HTTP client, the build server's sockets, ...) is imported where it's used, to keep startup fast.
+import collections
+import contextlib
 import errno
 import hashlib
+import importlib.util
 import itertools
-import multiprocessing
+import json
+import marshal
+import mmap
 import os
-import pickle
-import pipes
 import queue
 import re
-import shlex
-import shutil
+import stat
 import struct
-import subprocess
 import sys
 import threading
 import time
 from optparse import OptionParser
 
-# The imp module is deprecated, but importlib doesn't have the functionality we need.
-# Or rather, it might, but the documentation doesn't make it clear. So just suppress the warning.
-import warnings
-with warnings.catch_warnings():
-    warnings.simplefilter("ignore")
-    import imp
+# When make.py runs as a script (or as the main module of a --parallel-rules worker), make it importable as "make" too,
+# so that pickled rules (which refer to make.Rule) load the same way everywhere, rather than in a second copy of it
+if __name__ in ('__main__', '__mp_main__'):
+    sys.modules.setdefault('make', sys.modules[__name__])
 
 visited = set()
-enqueued = set()
 completed = set()
 building = set()
 rules = {}
 make_db = {}
 normpath_cache = {}
+hash_cache = {} # path -> (size, mtime_ns, inode, digest, racy) for --hash; saved across runs
+d_file_cache = {} # .d file path -> ((mtime_ns, size, cwd), normalized deps, racy); saved across runs
+d_file_cache_dirty = False
 task_queue = queue.PriorityQueue()
 priority_queue_counter = 0 # tiebreaker counter to fall back to FIFO when rule priorities are the same
 any_errors = False
+jobs_outstanding = 0 # rules handed to the builder threads that haven't finished yet
+targets_left = 0 # visited targets of rules that haven't completed yet, for the progress indicator
 
-# This is used to work around some Python bugs:
-# 1. It would be nice if sys.stdout.write from multiple threads were atomic, but I've observed problems.
-# 2. On Windows, if one thread calls subprocess.Popen while another thread has a file handle from open()
-# open, the file handle will be incorrectly and unintentionally inherited by the child process.  This
-# leads to really strange file locking errors.
-# XXX Split io_lock into stdout_lock and subprocess_io_lock
-# XXX Maybe make one or both conditional on platform (certainly I don't think Unix has the subprocess bug)
-io_lock = threading.Lock()
+# Protects the scheduler state (completed, jobs_outstanding, targets_left, and each rule's pending/dependents) that
+# both the main thread and the builder threads update. It is notified whenever a rule starts or completes, or when
+# a builder thread hits an error, so the main thread can sleep until something actually happens.
+build_cond = threading.Condition()
+
+# It would be nice if sys.stdout.write from multiple threads were atomic, but I've observed problems.
+stdout_lock = threading.Lock()
+
+# On Windows, if one thread calls subprocess.Popen while another thread is in the middle of its own Popen, the other
+# child's pipe handles can be unintentionally inherited by this child process, so that pipe doesn't get closed until
+# both children exit (and older Pythons had the same problem with any file handle from open()). This leads to really
+# strange hangs and file locking errors. POSIX creates the pipes close-on-exec, so there, processes are spawned
+# concurrently with no lock at all.
+spawn_lock = threading.Lock() if os.name == 'nt' else contextlib.nullcontext()
 
 # An atomic write to stdout from any thread
 def stdout_write(x):
-    with io_lock:
+    with stdout_lock:
         sys.stdout.write(x)
         sys.stdout.flush()
 
+# Print what a rule printed (a list of strings, and OutputCaptures whose output was spilled to a temp file)
+def write_rule_output(built_text, all_out):
+    with stdout_lock:
+        sys.stdout.write(built_text)
+        for (i, out) in enumerate(all_out):
+            if i:
+                sys.stdout.write('\n')
+            if isinstance(out, OutputCapture):
+                sys.stdout.flush()
+                out.write_to(sys.stdout)
+            else:
+                sys.stdout.write(out)
+        sys.stdout.write('\n\n')
+        sys.stdout.flush()
+
+# What --stats prints at the end: wall time spent in each phase of make.py's work, and counts of interesting events
+PHASES = ['parse rules', 'critical path', 'stale cleanup', 'load caches', 'graph traversal', 'jobs', 'make.db',
+        'save caches'] # in the order they happen, for printing
+phase_times = collections.Counter(dict.fromkeys(PHASES, 0))
+counters = collections.Counter() # only kept with --stats, and not locked, so counts from builder threads may be low
+counting = False # whether --stats is on
+
+# With --trace, a list of events in Chrome's trace event format (which chrome://tracing and Perfetto can open): the
+# phases of make.py's work on the main thread (tid 0), and every rule and command on the builder slot that ran it
+trace_events = None
+trace_start = 0
+trace_queued = {} # rule -> when it was queued to run
+
+def add_trace_event(name, cat, start, end, tid=0, args=None):
+    event = {'name': name, 'cat': cat, 'ph': 'X', 'pid': 1, 'tid': tid,
+             'ts': (start - trace_start) * 1e6, 'dur': (end - start) * 1e6}
+    if args:
+        event['args'] = args
+    trace_events.append(event)
+
+# Record a phase that started at the given time and just ended, returning the time it ended
+def trace_phase(name, start):
+    end = time.perf_counter()
+    phase_times[name] += end - start
+    if trace_events is not None:
+        add_trace_event(name, 'phase', start, end)
+    return end
+
+def trace_rule(rule, slot, start):
+    if trace_events is not None:
+        args = {'targets': rule.targets, 'priority': rule.priority}
+        queued = trace_queued.pop(rule, None)
+        if queued is not None:
+            args['queue_wait_ms'] = (start - queued) * 1000
+        add_trace_event(os.path.basename(rule.targets[0]), 'rule', start, time.perf_counter(), slot, args)
+
+def trace_cmd(cmd, code, slot, start):
+    if trace_events is not None:
+        add_trace_event(os.path.basename(cmd[0]), 'cmd', start, time.perf_counter(), slot,
+                {'cmd': cmd, 'exit_code': code})
+
+def print_stats():
+    out = ['Time per phase:\n']
+    out += ['  %-30s %8.3fs\n' % (name, t) for (name, t) in phase_times.items()]
+    out.append('Counters:\n')
+    out += ['  %-30s %8d\n' % (name, counters[name]) for name in sorted(counters)]
+    stdout_write(''.join(out))
+
+def save_trace(path, jobs):
+    names = [{'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': 0, 'args': {'name': 'make.py'}}]
+    names += [{'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': slot, 'args': {'name': 'builder %d' % slot}}
+              for slot in range(1, jobs + 1)]
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': names + trace_events, 'displayTimeUnit': 'ms'}, f)
+
+# Cache of stat results for the current build, since the same headers are checked over and over. The first lookup
+# in a directory lists the whole directory with os.scandir, which answers every lookup of a nonexistent file in it
+# without a syscall, unless the directory ignores case (on Windows, where scandir returns full stat info for free,
+# every lookup). Anything that writes or removes files during the build must call refresh_stat() on them.
+stat_cache = {} # path -> os.stat_result, or None if nonexistent
+dir_listings = {} # dir -> set of names in it, or None if it couldn't be listed
+stat_lock = threading.Lock()
+stat_generation = 0 # bumped by every refresh_stat(), so that lookups racing with one don't cache stale results
+
+def get_dir_listing(dir):
+    listing = dir_listings.get(dir, False)
+    if listing is not False:
+        return listing
+    generation = stat_generation
+    stats = {}
+    if counting:
+        counters['stat calls'] += 1 # one scandir call
+    try:
+        with os.scandir(dir) as it:
+            if os.name == 'nt':
+                for entry in it:
+                    stats[normpath('%s/%s' % (dir, entry.name))] = entry.stat()
+                listing = {path.rsplit('/', 1)[1] for path in stats}
+            else:
+                listing = {entry.name for entry in it}
+        if os.name != 'nt' and is_case_insensitive_dir(dir, listing):
+            listing = None # a miss in the listing doesn't mean a differently-cased name doesn't exist
+    except (FileNotFoundError, NotADirectoryError):
+        listing = set() # nothing in here exists
+    except OSError:
+        listing = None # can't list it, so fall back to stat'ing each path
+    with stat_lock:
+        if generation == stat_generation:
+            dir_listings[dir] = listing
+            stat_cache.update(stats)
+    return listing
+
+# Whether names in a dir are looked up without regard to case (as on macOS by default), going by whether one of its
+# entries can also be found with its case swapped. On Windows, normpath lowercases paths, so listings match anyway.
+def is_case_insensitive_dir(dir, listing):
+    for name in listing:
+        swapped = name.swapcase()
+        if swapped != name and swapped not in listing:
+            if counting:
+                counters['stat calls'] += 1
+            return os.path.lexists('%s/%s' % (dir.rstrip('/'), swapped))
+    return False # no names with letters, so case can't make a lookup miss
+
+def get_stat(path):
+    st = stat_cache.get(path, False)
+    if st is not False:
+        return st
+    generation = stat_generation
+    (dir, _, name) = path.rpartition('/')
+    if not dir or dir.endswith(':'):
+        dir += '/'
+    listing = get_dir_listing(dir)
+    if listing is not None and name not in listing:
+        st = None
+    else:
+        if counting:
+            counters['stat calls'] += 1
+        try:
+            st = os.stat(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            st = None
+    with stat_lock:
+        if generation == stat_generation:
+            stat_cache[path] = st
+    return st
+
+# Update the stat cache for a path that we just wrote, removed, or created
+def refresh_stat(path):
+    global stat_generation
+    if counting:
+        counters['stat calls'] += 1
+    try:
+        st = os.stat(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+        st = None
+    (dir, _, name) = path.rpartition('/')
+    if not dir or dir.endswith(':'):
+        dir += '/'
+    with stat_lock:
+        stat_generation += 1
+        stat_cache[path] = st
+        listing = dir_listings.get(dir)
+        if listing is not None:
+            if st is None:
+                listing.discard(name)
+            else:
+                listing.add(name)
+
 # By querying both a file's existence and its timestamp in a single syscall, we can get
 # a significant speedup, especially for network file systems.
 def get_timestamp_if_exists(path):
+    st = get_stat(path)
+    return -1 if st is None else st.st_mtime
+
+# Returns the content digest of a file, or None if it doesn't exist. A file is only rehashed if its size, timestamp, or
+# inode changed since the last time we hashed it, so checking an unchanged tree costs little more than the stat calls.
+def get_digest(path):
+    st = get_stat(path)
+    if st is None:
+        return None
+    key = (st.st_size, st.st_mtime_ns, st.st_ino)
+    entry = hash_cache.get(path)
+    if entry is not None and entry[:3] == key:
+        return entry[3]
+    h = hashlib.blake2b(digest_size=20)
+    if stat.S_ISDIR(st.st_mode):
+        h.update(b'dir %d' % st.st_mtime_ns) # directories have no contents to hash, so fall back on their timestamps
+    else:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    digest = h.hexdigest()
+    # A file modified within the last second could be modified again without its timestamp visibly changing, so such
+    # "racy" entries are good for this build only and aren't saved
+    racy = st.st_mtime_ns > time.time_ns() - 1000000000
+    hash_cache[path] = key + (digest, racy)
+    return digest
+
+# A single digest covering the names and contents of a list of dependencies
+def get_deps_digest(deps):
+    h = hashlib.blake2b(digest_size=20)
+    for dep in deps:
+        h.update(('%s %s\n' % (dep, get_digest(dep))).encode())
+    return h.hexdigest()
+
+# Load one of the caches we keep in _out, returning None if it's missing or unreadable
+def load_pickle(path):
     try:
-        return os.stat(path).st_mtime
-    except OSError as e:
-        if e.errno == errno.ENOENT:
-            return -1
-        raise
+        with open(path, 'rb') as f:
+            import pickle
+            return pickle.load(f)
+    except Exception:
+        return None
+
+# A name to write a file under before renaming it into place. The build cache can be shared with other builds running
+# concurrently, and several threads of one build can write the same file, so it has to be unique to both.
+def get_tmp_path(path):
+    return '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+
+def save_pickle(path, obj):
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    import pickle
+    tmp_path = get_tmp_path(path)
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+def save_hash_cache(path):
+    save_pickle(path, {file: entry for (file, entry) in hash_cache.items() if not entry[4]})
 
+# Normalized paths are interned, so each path is only stored once in memory however many rules refer to it, and
+# comparing or hashing the same path again is cheap
 def normpath(path):
     if path in normpath_cache:
         return normpath_cache[path]
     ret = os.path.normpath(path)
     if os.name == 'nt':
         ret = ret.lower().replace('\\', '/')
-    normpath_cache[path] = ret
+    ret = sys.intern(ret)
+    normpath_cache[ret if ret == path else path] = ret # most paths are already normalized, so don't keep two copies
     return ret
+plain_normpath = normpath
+
+# With --stats, this replaces normpath(), so that builds without it don't pay for counting the cache hits
+def counting_normpath(path):
+    counters['normpath cache hits' if path in normpath_cache else 'normpath cache misses'] += 1
+    return plain_normpath(path)
 
 if os.name == 'nt': # evaluate this condition only once, rather than per call, for performance
     def joinpath(cwd, path):
@@ -101,6 +341,7 @@ else:
 def remove_path(cwd, path):
     try:
         os.unlink(path)
+        refresh_stat(path)
     except FileNotFoundError:
         pass
     except (PermissionError, IsADirectoryError):
@@ -108,112 +349,620 @@ def remove_path(cwd, path):
             # Check that the path is within the relevant _out directory
             out_dir = '%s/_out/' % os.path.realpath(cwd)
             if os.path.realpath(path).startswith(out_dir):
+                import shutil
                 shutil.rmtree(path)
+                # We don't know what was cached from inside it, so start over
+                with stat_lock:
+                    stat_cache.clear()
+                    dir_listings.clear()
+                refresh_stat(path)
             else:
                 stdout_write("WARNING: not removing target directory '%s' that "
                         "is not in output directory '%s'\n" % (path, out_dir))
             return
         raise
 
-def run_cmd(rule, options):
-    # Always delete the targets first
+SHOW_INCLUDES_RE = re.compile('^Note: including file:\\s*(.*)$')
+OUTPUT_MEMORY_LIMIT = 1 << 20 # how much of a command's output to keep in memory before spilling it to a temp file
+
+# Captures the combined stdout/stderr output of a command as it runs, filtering it line by line as it arrives (and
+# collecting the dependencies from /showIncludes output), so that commands printing lots of output don't have it all
+# held in memory at once, and optionally printing each line straight away (--live-output).
+class OutputCapture:
+    def __init__(self, rule, live_prefix=None):
+        self.rule = rule
+        self.live_prefix = live_prefix
+        self.filter = SHOW_INCLUDES_RE.match if rule.msvc_show_includes else rule.stdout_filter_match
+        self.partial = b'' # the start of a line whose end we haven't received yet
+        self.lines = []
+        self.line_count = 0
+        self.size = 0
+        self.spill = None # temp file holding the output, once there's too much to keep in memory
+        self.show_includes = set()
+
+    def feed(self, data):
+        lines = (self.partial + data).split(b'\n')
+        self.partial = lines.pop()
+        for line in lines:
+            self.add_line(line.decode(errors='replace')) # XXX What encoding should we use here??  This assumes UTF-8
+
+    def close(self):
+        if self.partial:
+            self.add_line(self.partial.decode(errors='replace'))
+            self.partial = b''
+
+    def add_line(self, line):
+        line = line.rstrip('\r')
+        if self.filter is not None:
+            m = self.filter(line)
+            if m:
+                if self.rule.msvc_show_includes:
+                    dep = normpath(m.group(1))
+                    if not dep.startswith('c:/program files'):
+                        self.show_includes.add(dep)
+                return
+        self.line_count += 1
+        if self.live_prefix is not None:
+            erase = '\r%s\r' % (' ' * usable_columns) if progress_line else ''
+            stdout_write('%s%s%s\n' % (erase, self.live_prefix, line))
+        if self.spill is None:
+            self.lines.append(line)
+            self.size += len(line) + 1
+            if self.size > OUTPUT_MEMORY_LIMIT:
+                import tempfile
+                self.spill = tempfile.TemporaryFile('w+', encoding='utf-8', errors='replace')
+                self.spill.write('\n'.join(self.lines))
+                self.lines = []
+        else:
+            self.spill.write('\n' + line)
+
+    # The captured output, or None if it was spilled to a temp file (see write_to())
+    def getvalue(self):
+        if self.spill is not None:
+            return None
+        if self.rule.msvc_show_includes and self.line_count == 1:
+            return '' # the one line of output left after the /showIncludes messages is just the source file name
+        return '\n'.join(self.lines).strip()
+
+    def write_to(self, f):
+        import shutil
+        self.spill.seek(0)
+        shutil.copyfileobj(self.spill, f)
+        self.spill.close()
+
+# Run a command, feeding its combined stdout/stderr output to an OutputCapture as it arrives, and return its exit code
+def execute_cmd(cmd, cwd, capture):
+    import subprocess
+    with spawn_lock:
+        try:
+            p = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        except Exception as e:
+            capture.add_line(str(e))
+            return 1
+    for data in iter(lambda: p.stdout.read1(65536), b''):
+        capture.feed(data)
+    capture.close()
+    return p.wait()
+
+# The build cache (--cache-dir) keeps the outputs of rules under a key covering the rule and the contents of its
+# dependencies, so building the same thing again, in this tree or any other one sharing the cache, just restores them.
+# A rule's .d dependencies aren't known until it has run, so the key only covers its regular dependencies, and the
+# manifest stored under the key lists each result along with the .d dependencies (and their digests) it was built from,
+# the way ccache's direct mode works. Paths inside the top-level directory (the one with the first rules.py file) are
+# stored relative to it, so that different checkouts of the same tree can share a cache.
+cache_base_dir = None
+cache_bytes_stored = 0
+CACHE_BASE = '\0base\0' # stands in for cache_base_dir; can't collide with a real path
+CACHE_MANIFEST_RESULTS = 8 # number of results (e.g. for different versions of a header) to remember per key
+
+def relocate(text):
+    return text.replace(cache_base_dir, CACHE_BASE)
+
+def unrelocate(text):
+    return text.replace(CACHE_BASE, cache_base_dir)
+
+def get_cache_key(rule, deps):
+    info = [encode_rule(rule)]
+    for dep in deps:
+        info += [dep, get_digest(dep) or '']
+    return hashlib.blake2b(relocate('\0'.join(info)).encode(), digest_size=20).hexdigest()
+
+def get_cache_path(options, kind, key):
+    return '%s/%s/%s/%s' % (options.cache_dir, kind, key[:2], key)
+
+# Restore a rule's outputs from the build cache, returning the output its commands printed, or None on a cache miss
+def cache_fetch(options, rule, key):
+    manifest_path = get_cache_path(options, 'ac', key)
+    result = find_cache_result(load_pickle(manifest_path) or [])
+    if result is None:
+        return None
+    try:
+        for (t, digest) in zip(rule.targets, result['outputs']):
+            blob_path = get_cache_path(options, 'cas', digest)
+            # A hard link shares its timestamp with the blob and every other tree's link to it, so only use one in
+            # --hash mode, where timestamps don't matter; otherwise the target gets a copy with a fresh timestamp
+            if options.cache_hardlink and options.hash:
+                try:
+                    os.link(blob_path, t)
+                    continue
+                except OSError:
+                    pass
+            import shutil
+            shutil.copyfile(blob_path, t)
+        if result['d_file'] is not None:
+            with open(rule.d_file, 'wt') as f:
+                f.write(unrelocate(result['d_file']))
+    except OSError: # most likely evicted by another build in the meantime
+        for t in rule.targets:
+            remove_path(rule.cwd, t)
+        return None
+    os.utime(manifest_path)
+    return unrelocate(result['out'])
+
+# The first of the results stored under a key whose .d dependencies have the same contents as ours
+def find_cache_result(results):
+    for result in results:
+        if all(get_digest(unrelocate(dep)) == digest for (dep, digest) in result['d_deps']):
+            return result
+    return None
+
+# Add a result to the manifest for a key, replacing any result for the same .d dependencies
+def add_cache_result(options, key, result):
+    manifest_path = get_cache_path(options, 'ac', key)
+    manifest = [x for x in load_pickle(manifest_path) or [] if x['d_deps'] != result['d_deps']]
+    manifest.insert(0, result)
+    save_pickle(manifest_path, manifest[:CACHE_MANIFEST_RESULTS])
+
+# Store a rule's freshly built outputs in the build cache, returning the new result (or None if the rule can't be
+# cached). Only rules whose targets are all regular files are cached.
+def cache_store(options, rule, key, out):
+    global cache_bytes_stored
+    outputs = []
+    for t in rule.targets:
+        st = get_stat(t)
+        if st is None or not stat.S_ISREG(st.st_mode):
+            return None
+        digest = get_digest(t)
+        blob_path = get_cache_path(options, 'cas', digest)
+        if not os.path.exists(blob_path):
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            import shutil
+            tmp_path = get_tmp_path(blob_path)
+            shutil.copyfile(t, tmp_path)
+            os.replace(tmp_path, blob_path)
+            cache_bytes_stored += st.st_size
+        outputs.append(digest)
+    d_deps = [(relocate(dep), get_digest(dep)) for dep in get_d_file_deps(rule)]
+    d_file = None
+    if rule.d_file and get_stat(rule.d_file) is not None:
+        with open(rule.d_file, 'rt') as f:
+            d_file = relocate(f.read())
+    result = {'d_deps': d_deps, 'outputs': outputs, 'd_file': d_file, 'out': relocate(out)}
+    add_cache_result(options, key, result)
+    return result
+
+# The remote cache (--remote-cache) is an HTTP server holding the same things as the local build cache: GET/PUT
+# /ac/<key> for the manifest stored under a key (as JSON), and GET/HEAD/PUT /cas/<digest> for the contents of a file.
+# Lookups are started on a thread pool as soon as a rule is queued and uploads happen there in the background, so the
+# network never holds up the builders. A result found remotely is downloaded into the local cache and restored from
+# there. See cache_server.py for a server.
+remote_pool = None
+remote_cache_failed = False
+
+def remote_cache_request(options, method, path, data=None):
+    import http.client, urllib.error, urllib.request
+    global remote_cache_failed
+    if remote_cache_failed:
+        return None
+    url = '%s/%s' % (options.remote_cache.rstrip('/'), path)
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, data=data, method=method), timeout=30) as f:
+            return f.read()
+    except urllib.error.HTTPError: # e.g. 404 for something the server doesn't have
+        return None
+    except (OSError, http.client.HTTPException) as e:
+        # Don't slow down the rest of the build by timing out on every rule
+        remote_cache_failed = True
+        stdout_write("WARNING: not using remote cache '%s' for the rest of the build: %s\n" % (options.remote_cache, e))
+        return None
+
+def load_remote_manifest(options, key):
+    data = remote_cache_request(options, 'GET', 'ac/%s' % key)
+    try:
+        results = json.loads(data) if data is not None else []
+        for result in results:
+            result['d_deps'] = [tuple(dep) for dep in result['d_deps']]
+        return results
+    except (ValueError, TypeError, KeyError):
+        return []
+
+# Compute a rule's cache key, and if the local cache doesn't have a result for it, try to download one from the remote
+# cache into the local cache
+def remote_cache_fetch(options, rule):
+    global cache_bytes_stored
+    key = get_cache_key(rule, rule.dep_paths)
+    if find_cache_result(load_pickle(get_cache_path(options, 'ac', key)) or []) is not None:
+        return key
+    result = find_cache_result(load_remote_manifest(options, key))
+    if result is None:
+        return key
+    for digest in result['outputs']:
+        blob_path = get_cache_path(options, 'cas', digest)
+        if os.path.exists(blob_path):
+            continue
+        data = remote_cache_request(options, 'GET', 'cas/%s' % digest)
+        if data is None or hashlib.blake2b(data, digest_size=20).hexdigest() != digest:
+            return key
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        tmp_path = get_tmp_path(blob_path)
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, blob_path)
+        cache_bytes_stored += len(data)
+    add_cache_result(options, key, result)
+    return key
+
+# Upload a result just stored in the local cache, files first so that the manifest never refers to missing ones
+def remote_cache_store(options, key, result):
+    try:
+        for digest in result['outputs']:
+            if remote_cache_request(options, 'HEAD', 'cas/%s' % digest) is None:
+                with open(get_cache_path(options, 'cas', digest), 'rb') as f:
+                    if remote_cache_request(options, 'PUT', 'cas/%s' % digest, f.read()) is None:
+                        return
+        results = [x for x in load_remote_manifest(options, key) if x['d_deps'] != result['d_deps']]
+        results.insert(0, result)
+        remote_cache_request(options, 'PUT', 'ac/%s' % key, json.dumps(results[:CACHE_MANIFEST_RESULTS]).encode())
+    except OSError: # evicted from the local cache by another build in the meantime
+        pass
+
+# Keep the build cache under its size limit by evicting the least recently used files. Walking the whole cache is slow,
+# so a running estimate of its size is kept in a stats file, and we only walk it once that goes over the limit.
+def trim_cache(options):
+    stats_path = '%s/stats' % options.cache_dir
+    stats = load_pickle(stats_path) or {'size': 0}
+    stats['size'] += cache_bytes_stored
+    if stats['size'] > options.cache_size:
+        # Restoring a result only touches its manifest (blobs can be hard linked into trees, so their timestamps
+        # aren't ours to change), so a blob counts as used as recently as the newest manifest that refers to it
+        files = []
+        blob_times = {}
+        for kind in ('ac', 'cas'):
+            for (dirpath, dirnames, filenames) in os.walk('%s/%s' % (options.cache_dir, kind)):
+                for name in filenames:
+                    path = '%s/%s' % (dirpath, name)
+                    try:
+                        st = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    mtime = st.st_mtime
+                    if kind == 'ac':
+                        for result in load_pickle(path) or []:
+                            for digest in result['outputs']:
+                                blob_times[digest] = max(blob_times.get(digest, 0), mtime)
+                    else:
+                        mtime = max(mtime, blob_times.get(name, 0))
+                    files.append((mtime, st.st_size, path))
+        files.sort()
+        total = sum(size for (mtime, size, path) in files)
+        for (mtime, size, path) in files:
+            if total <= options.cache_size * 0.9: # leave some headroom, so we don't have to do this on every build
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        stats['size'] = total
+    save_pickle(stats_path, stats)
+
+def parse_size(text):
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    text = text.upper().rstrip('B')
+    if text[-1:] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+# Carry out a rule: yields each command to run along with the OutputCapture for its output, to be sent back its exit
+# code, or a future to be sent back its result. This way the thread and the asyncio build engines share everything but
+# how the commands actually get run and waited for; see run_cmd() and run_cmd_async().
+def run_rule(rule, options):
+    # Always delete the targets first. For early cutoff, remember the timestamps of the ones that are still exactly
+    # what we built last time, so we can put them back if the rule regenerates them identically.
     local_make_db = make_db[rule.cwd]
+    early_cutoff = options.early_cutoff and not options.hash # --hash doesn't look at timestamps, so it has nothing to do
+    old_mtimes = {}
+    duration = None
     for t in rule.targets:
+        entry = local_make_db.get(t, NO_DB_ENTRY)
+        if entry is not NO_DB_ENTRY:
+            make_db_delete(rule.cwd, t)
+            duration = entry.duration
+        if early_cutoff and entry.output_digest is not None and get_digest(t) == entry.output_digest:
+            old_mtimes[t] = (entry.output_digest, get_stat(t).st_mtime_ns)
         remove_path(rule.cwd, t)
-        if t in local_make_db:
-            del local_make_db[t]
 
     built_text = "Built '%s'.\n" % "'\n  and '".join(rule.targets)
     if progress_line: # need to precede "Built [...]" with erasing the current progress indicator
         built_text = '\r%s\r%s' % (' ' * usable_columns, built_text)
 
+    # With a build cache, first see if it already has the outputs of this exact rule built from these exact inputs
     all_out = []
-    for cmd in rule.cmds:
-        # Run command, capture/filter its output, and get its exit code.
-        # XXX Do we want to add an additional check that all the targets must exist?
-        with io_lock:
-            try:
-                p = subprocess.Popen(cmd, cwd=rule.cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-            except Exception as e:
-                p = None
-                out = str(e)
-                code = 1
-        if p is not None:
-            out = p.stdout.read().decode().strip() # XXX What encoding should we use here??  This assumes UTF-8
-            code = p.wait()
-        if rule.msvc_show_includes:
-            deps = set()
-            r = re.compile('^Note: including file:\\s*(.*)$')
-            new_out = []
-            for line in out.splitlines():
-                m = r.match(line)
-                if m:
-                    dep = normpath(m.group(1))
-                    if not dep.startswith('c:/program files'):
-                        deps.add(dep)
-                else:
-                    new_out.append(line)
-            with io_lock:
+    cmd_outs = [] # the output of each command, for the build cache (None if there was too much to save)
+    cache_key = None
+    cached_out = None
+    if options.cache_dir:
+        if remote_pool is not None:
+            # The remote lookup normally got started when the rule was queued (see start_rules()), so wait for it
+            if rule.remote_fetch is None:
+                rule.remote_fetch = remote_pool.submit(remote_cache_fetch, options, rule)
+            cache_key = yield rule.remote_fetch
+            rule.remote_fetch = None
+        else:
+            cache_key = get_cache_key(rule, rule.dep_paths)
+        cached_out = cache_fetch(options, rule, cache_key)
+    if cached_out is not None:
+        if counting:
+            counters['rules restored from the build cache'] += 1
+        if options.verbose:
+            all_out.append('(restored from the build cache)')
+        if cached_out:
+            all_out.append(cached_out)
+    else:
+        live_prefix = '[%s] ' % os.path.basename(rule.targets[0]) if options.live_output else None
+        start_time = time.monotonic()
+        for cmd in rule.cmds:
+            # Run command, capture/filter its output, and get its exit code.
+            # XXX Do we want to add an additional check that all the targets must exist?
+            capture = OutputCapture(rule, live_prefix)
+            code = yield (cmd, capture)
+            if rule.msvc_show_includes:
                 with open(rule.d_file, 'wt') as f:
                     assert len(rule.targets) == 1
                     f.write('%s: \\\n' % rule.targets[0])
-                    for dep in sorted(deps):
+                    for dep in sorted(capture.show_includes):
                         f.write('  %s \\\n' % dep)
                     f.write('\n')
 
-            # In addition to filtering out the /showIncludes messages, filter the one remaining
-            # line of output where it just prints the source file name
-            if len(new_out) == 1:
-                out = ''
-            else:
-                out = '\n'.join(new_out)
-        elif rule.stdout_filter:
-            r = re.compile(rule.stdout_filter)
-            out = '\n'.join(line for line in out.splitlines() if not r.match(line))
+            out = capture.getvalue()
+            if out is None:
+                cmd_outs = None # too much output to save in the build cache
+            elif out and cmd_outs is not None:
+                cmd_outs.append(out)
+            if options.verbose or code:
+                if os.name == 'nt':
+                    import subprocess
+                    all_out.append(subprocess.list2cmdline(cmd))
+                else:
+                    import shlex
+                    all_out.append(' '.join(shlex.quote(x) for x in cmd))
+            if live_prefix is not None:
+                if out is None:
+                    capture.spill.close() # already printed, so we're done with the temp file
+            elif out is None:
+                all_out.append(capture)
+            elif out:
+                all_out.append(out)
+            if code:
+                global any_errors
+                any_errors = True
+                write_rule_output(built_text, all_out)
+                for t in rule.targets:
+                    remove_path(rule.cwd, t)
+                exit(1)
 
-        if options.verbose or code:
-            if os.name == 'nt':
-                out = '%s\n%s' % (subprocess.list2cmdline(cmd), out)
-            else:
-                out = '%s\n%s' % (' '.join(pipes.quote(x) for x in cmd), out)
-            out = out.rstrip()
-        if out:
-            all_out.append(out)
-        if code:
-            global any_errors
-            any_errors = True
-            stdout_write("%s%s\n\n" % (built_text, '\n'.join(all_out)))
-            for t in rule.targets:
-                remove_path(rule.cwd, t)
-            exit(1)
+        # Fold how long this took into the rule's average duration. Restoring from the build cache says nothing about
+        # how long the rule would take to run, so that doesn't count.
+        elapsed = time.monotonic() - start_time
+        duration = elapsed if duration is None else duration + DURATION_EMA_WEIGHT * (elapsed - duration)
+
+    # Forget what we knew about the files the rule just wrote
+    for t in rule.targets:
+        refresh_stat(t)
+    if rule.d_file:
+        refresh_stat(rule.d_file)
+
+    if cache_key is not None and cached_out is None and cmd_outs is not None:
+        result = cache_store(options, rule, cache_key, '\n'.join(cmd_outs))
+        if result is not None and remote_pool is not None:
+            remote_pool.submit(remote_cache_store, options, cache_key, result)
 
+    # In --hash mode, record the contents of the dependencies this rule was built from, using the .d file it just wrote
+    deps = rule.dep_paths + get_d_file_deps(rule)
+    deps_digest = get_deps_digest(deps) if options.hash else None
+
+    # Record the contents of the new targets too. If early cutoff finds that one came out identical to what we built
+    # last time, it gets its old timestamp back so that its dependents don't rebuild; the rule itself then remembers
+    # the timestamp of its newest input, so it doesn't look out of date against the inputs it was just built from.
+    output_digests = {}
+    inputs_mtime = None
+    if options.hash or options.early_cutoff:
+        for t in rule.targets:
+            output_digests[t] = get_digest(t)
+            if t in old_mtimes and old_mtimes[t][0] == output_digests[t] and get_stat(t).st_nlink == 1:
+                os.utime(t, ns=(get_stat(t).st_atime_ns, old_mtimes[t][1]))
+                refresh_stat(t)
+                inputs_mtime = max([get_timestamp_if_exists(dep) for dep in deps], default=-1)
+    signature = rule.signature()
     for t in rule.targets:
-        local_make_db[t] = rule.signature()
+        make_db_put(rule.cwd, t, DbEntry(signature, deps_digest, output_digests.get(t), inputs_mtime, duration))
     if all_out:
-        stdout_write('%s%s\n\n' % (built_text, '\n'.join(all_out)))
+        write_rule_output(built_text, all_out)
     elif not progress_line:
         stdout_write(built_text)
 
+def run_cmd(rule, options, slot=0):
+    start = time.perf_counter()
+    steps = run_rule(rule, options)
+    try:
+        step = next(steps)
+        while True:
+            if not isinstance(step, tuple): # a remote cache lookup (see remote_cache_fetch())
+                step = steps.send(step.result())
+            else:
+                cmd_start = time.perf_counter()
+                code = execute_cmd(step[0], rule.cwd, step[1])
+                trace_cmd(step[0], code, slot, cmd_start)
+                step = steps.send(code)
+    except StopIteration:
+        pass
+    finally:
+        trace_rule(rule, slot, start)
+
+async def execute_cmd_async(cmd, cwd, capture):
+    import asyncio, subprocess
+    try:
+        p = await asyncio.create_subprocess_exec(*cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    except Exception as e:
+        capture.add_line(str(e))
+        return 1
+    while True:
+        data = await p.stdout.read(65536)
+        if not data:
+            break
+        capture.feed(data)
+    capture.close()
+    return await p.wait()
+
+async def run_cmd_async(rule, options, slot):
+    import asyncio
+    start = time.perf_counter()
+    steps = run_rule(rule, options)
+    try:
+        step = next(steps)
+        while True:
+            if not isinstance(step, tuple): # a remote cache lookup (see remote_cache_fetch())
+                step = steps.send(await asyncio.wrap_future(step))
+            else:
+                cmd_start = time.perf_counter()
+                code = await execute_cmd_async(step[0], rule.cwd, step[1])
+                trace_cmd(step[0], code, slot, cmd_start)
+                step = steps.send(code)
+    except StopIteration:
+        pass
+    finally:
+        trace_rule(rule, slot, start)
+
+# What make.db remembers about each target built by a rule: the rule's signature; in --hash mode, the digest of its
+# dependencies' contents at the time it was built; with --hash or --early-cutoff, the digest of the target itself; if
+# early cutoff restored an older timestamp on any of the rule's targets, the timestamp of the rule's newest input; and
+# how long the rule takes to run, in seconds, as a moving average over its builds (see propagate_latencies())
+DbEntry = collections.namedtuple('DbEntry', ['signature', 'deps_digest', 'output_digest', 'inputs_mtime', 'duration'],
+        defaults=[None, None, None, None])
+NO_DB_ENTRY = DbEntry(None)
+DURATION_EMA_WEIGHT = 0.3 # how much the latest build counts for in a rule's average duration
+
+# Compile a rule's stdout_filter, which is a regex or a list of them, into a function matching a line of output against
+# it. Lists are merged into a single regex where possible, so each line of output is only matched once. Many rules
+# usually share the same filters, so each one is only compiled once.
+stdout_filters = {}
+LEADING_FLAGS_RE = re.compile(r'((?:\(\?[aiLmsux]+\))+)(.*)', re.DOTALL)
+
+# Wrap one of several filters for merging into a single regex. Global flags like (?i) are only allowed at the start of
+# a regex, so they become flags scoped to the filter's group instead.
+def scope_stdout_filter(pattern):
+    m = LEADING_FLAGS_RE.match(pattern)
+    if m is None:
+        return '(?:%s)' % pattern
+    return '(?%s:%s)' % (re.sub(r'[(?)]', '', m.group(1)), m.group(2))
+
+def compile_stdout_filter(stdout_filter):
+    if not stdout_filter:
+        return None
+    key = stdout_filter if isinstance(stdout_filter, str) else tuple(stdout_filter)
+    match = stdout_filters.get(key)
+    if match is None:
+        patterns = [stdout_filter] if isinstance(stdout_filter, str) else stdout_filter
+        regexes = []
+        for x in patterns:
+            try:
+                regexes.append(re.compile(x))
+            except re.error as e:
+                print("ERROR: invalid stdout_filter regex '%s': %s" % (x, e))
+                exit(1)
+        match = regexes[0].match
+        if len(regexes) > 1:
+            match = None
+            # Merging would renumber the filters' groups (breaking their backreferences) or clash their names, and a
+            # verbose-mode comment would swallow the rest of the merged regex, so those get matched one at a time
+            if all(r.groups == 0 and not r.flags & re.VERBOSE for r in regexes):
+                try:
+                    match = re.compile('|'.join(scope_stdout_filter(x) for x in patterns)).match
+                except re.error:
+                    pass
+            if match is None:
+                match = lambda line: any(r.match(line) for r in regexes)
+        stdout_filters[key] = match
+    return match
+
+# Encode a rule's definition for hashing. Unlike pickle, this encoding is the same across Python versions, so upgrading
+# Python doesn't change every signature and rebuild everything. NUL can't appear in a path or command-line argument, so
+# it separates the strings, and each list is preceded by its length.
+def encode_rule(rule):
+    (targets, deps, cmds) = (rule.targets, rule.deps, rule.cmds)
+    parts = [str(len(targets)), *targets, str(len(deps)), *deps, rule.cwd, str(len(cmds))]
+    for cmd in cmds:
+        parts.append(str(len(cmd)))
+        parts += cmd
+    parts += [rule.d_file or '', '1' if rule.msvc_show_includes else '']
+    try:
+        return '\0'.join(parts)
+    except TypeError: # e.g. pathlib paths
+        return '\0'.join(os.fsdecode(x) for x in parts)
+
 class Rule:
+    __module__ = 'make' # pickled rules refer to make.Rule, even when make.py runs as a script (see below)
+    # Large builds have hundreds of thousands of rules, so save the memory of a __dict__ per rule
+    __slots__ = ('targets', 'deps', 'cwd', 'cmds', 'd_file', 'order_only_deps', 'msvc_show_includes', 'stdout_filter',
+            'latency', 'dep_paths', 'priority', 'd_file_deps', 'pending', 'dependents', 'remote_fetch',
+            'cached_signature', 'stdout_filter_match')
+
     def __init__(self, targets, deps, cwd, cmds, d_file, order_only_deps, msvc_show_includes, stdout_filter, latency):
         self.targets = targets
         self.deps = deps
         self.cwd = cwd
+        self.dep_paths = [normpath(joinpath(cwd, x)) for x in deps] # deps, normalized
         self.cmds = cmds
         self.d_file = d_file
         self.order_only_deps = order_only_deps
         self.msvc_show_includes = msvc_show_includes
         self.stdout_filter = stdout_filter
+        self.stdout_filter_match = compile_stdout_filter(stdout_filter)
         self.latency = latency
         self.priority = 0
+        self.d_file_deps = [] # filled in from the .d file when the rule is visited
+        self.pending = 0 # number of dependencies that haven't completed yet
+        self.dependents = [] # rules waiting on this rule, one entry per dependency on it
+        self.remote_fetch = None # future for the rule's remote cache lookup
+        self.cached_signature = None
 
     # order_only_deps, stdout_filter, priority are excluded from signatures because none of them should affect the targets' new content.
+    # Rules don't change once they're added, so the signature is only computed once.
     def signature(self):
-        info = (self.targets, self.deps, self.cwd, self.cmds, self.d_file, self.msvc_show_includes)
-        return hashlib.sha1(pickle.dumps(info)).hexdigest()
+        if self.cached_signature is None:
+            if counting:
+                counters['signatures computed'] += 1
+            self.cached_signature = hashlib.sha1(encode_rule(self).encode()).hexdigest()
+        return self.cached_signature
+
+    # Only pickle the rule's definition (e.g. for the rules cache) and what's computed from it once, not the scheduler
+    # state of the current build. Loading a rule this way doesn't normalize its paths or compute its signature again.
+    def __getstate__(self):
+        return (self.targets, self.deps, self.cwd, self.cmds, self.d_file, self.order_only_deps, self.msvc_show_includes,
+                self.stdout_filter, self.latency, self.dep_paths, self.cached_signature)
+
+    def __setstate__(self, state):
+        (self.targets, self.deps, self.cwd, self.cmds, self.d_file, self.order_only_deps, self.msvc_show_includes,
+                self.stdout_filter, self.latency, self.dep_paths, self.cached_signature) = state
+        self.stdout_filter_match = compile_stdout_filter(self.stdout_filter) # looked up in stdout_filters once compiled
+        self.priority = 0
+        self.d_file_deps = []
+        self.pending = 0
+        self.dependents = []
+        self.remote_fetch = None
 
     def __repr__(self):
-        return '<Rule 0x%x %r>' % (id(self), self.__dict__)
+        return '<Rule 0x%x %r>' % (id(self), {name: getattr(self, name) for name in self.__slots__})
 
 class BuildContext:
     def __init__(self, vars):
@@ -237,53 +986,119 @@ class BuildContext:
             d_file = normpath(joinpath(cwd, d_file))
         assert isinstance(order_only_deps, list)
         order_only_deps = [normpath(joinpath(cwd, x)) for x in order_only_deps]
-        assert stdout_filter is None or isinstance(stdout_filter, str)
+        # we expect stdout_filter to be None, a regex str, or a list of them
+        assert stdout_filter is None or isinstance(stdout_filter, str) or \
+                (isinstance(stdout_filter, list) and all(isinstance(x, str) for x in stdout_filter))
+
+        self.insert_rule(Rule(targets, deps, cwd, cmds, d_file, order_only_deps, msvc_show_includes, stdout_filter, latency))
 
-        rule = Rule(targets, deps, cwd, cmds, d_file, order_only_deps, msvc_show_includes, stdout_filter, latency)
-        for t in targets:
+    def insert_rule(self, rule):
+        for t in rule.targets:
             if t in rules:
                 print("ERROR: multiple ways to build target '%s'" % t)
                 exit(1)
             rules[t] = rule
 
+# Collects the rules of a single rules.py file run by parse_rules_py_worker(), to be inserted later in the same order
+# as parse_rules_py() would have
+class CollectingContext(BuildContext):
+    def __init__(self, vars):
+        BuildContext.__init__(self, vars)
+        self.collected = []
+
+    def insert_rule(self, rule):
+        self.collected.append(rule)
+
 def parse_d_file(d_file):
-    with io_lock:
-        with open(d_file, 'rt') as f:
-            d_file_deps = f.read()
+    if counting:
+        counters['.d files parsed'] += 1
+    with open(d_file, 'rt') as f:
+        d_file_deps = f.read()
     d_file_deps = d_file_deps.replace('\\\n', '')
     if '\\' in d_file_deps: # shlex.split is slow, don't use it unless we really need it
+        import shlex
         d_file_deps = shlex.split(d_file_deps)
     else:
         d_file_deps = d_file_deps.split()
     d_file_deps = [x for x in d_file_deps if not x.endswith(':')]
     return d_file_deps
 
-def build(target, options):
+# The normalized dependencies listed in a rule's .d file, if it has one yet. The .d file is only parsed again once the
+# compiler rewrites it.
+def get_d_file_deps(rule):
+    global d_file_cache_dirty
+    if not rule.d_file:
+        return []
+    st = get_stat(rule.d_file)
+    if st is None:
+        return []
+    key = (st.st_mtime_ns, st.st_size, rule.cwd)
+    entry = d_file_cache.get(rule.d_file)
+    if entry is not None and entry[0] == key:
+        return entry[1]
+    deps = [normpath(joinpath(rule.cwd, x)) for x in parse_d_file(rule.d_file)]
+    # As with hash_cache, don't save entries for .d files that could still change without their timestamps changing
+    racy = st.st_mtime_ns > time.time_ns() - 1000000000
+    d_file_cache[rule.d_file] = (key, deps, racy)
+    d_file_cache_dirty = True
+    return deps
+
+def save_d_file_cache(path):
+    save_pickle(path, {d_file: entry for (d_file, entry) in d_file_cache.items() if not entry[2]})
+
+# Mark a target as visited, returning its rule if that still needs to be visited (along with its dependencies)
+def visit_target(target):
     if target in visited or target in completed:
-        return
+        return None
     if target not in rules:
         visited.add(target)
         completed.add(target)
-        return
+        return None
     rule = rules[target]
     visited.update(rule.targets)
-    if target in enqueued:
-        return
+    rule.d_file_deps = get_d_file_deps(rule)
+    # Start from a clean slate, in case a previous build in this process (see run_server()) stopped partway through
+    rule.pending = 0
+    rule.dependents = []
+    rule.remote_fetch = None
+    return rule
 
-    # Recursively handle the dependencies, including .d file dependencies and order-only deps
-    deps = [normpath(joinpath(rule.cwd, x)) for x in rule.deps]
-    d_file_deps = []
-    if rule.d_file and os.path.exists(rule.d_file):
-        d_file_deps = parse_d_file(rule.d_file)
-        d_file_deps = [normpath(joinpath(rule.cwd, x)) for x in d_file_deps]
-    for dep in itertools.chain(deps, d_file_deps, rule.order_only_deps):
-        build(dep, options)
-    if any(dep not in completed for dep in itertools.chain(deps, d_file_deps, rule.order_only_deps)):
+def build(target, options):
+    global targets_left
+    rule = visit_target(target)
+    if rule is None:
         return
 
-    # Don't build if already up to date
+    # Visit the dependencies depth-first, including .d file dependencies and order-only deps. This uses an explicit
+    # stack rather than recursion, which long chains of dependencies could take past Python's recursion limit.
+    all_deps = rule.dep_paths + rule.d_file_deps + rule.order_only_deps
+    stack = [(rule, all_deps, iter(all_deps))]
+    while stack:
+        (rule, all_deps, deps) = stack[-1]
+        for dep in deps:
+            dep_rule = visit_target(dep)
+            if dep_rule is not None:
+                dep_deps = dep_rule.dep_paths + dep_rule.d_file_deps + dep_rule.order_only_deps
+                stack.append((dep_rule, dep_deps, iter(dep_deps)))
+                break
+        else:
+            stack.pop()
+
+            # Wait on the dependencies that haven't completed yet -- whichever one completes last will start this rule
+            with build_cond:
+                targets_left += len(rule.targets)
+                for dep in all_deps:
+                    if dep not in completed:
+                        rules[dep].dependents.append(rule)
+                        rule.pending += 1
+                ready = not rule.pending
+            if ready:
+                start_rules([rule], options)
+
+def is_up_to_date(rule, options):
     # Slightly different rules for regular deps vs. d_file_deps -- always rebuild when a d_file_dep is nonexistent,
     # whereas we want to fail with an error when a regular dep is nonexistent
+    deps = rule.dep_paths
     target_timestamp = min(get_timestamp_if_exists(t) for t in rule.targets)
     dep_timestamps = [get_timestamp_if_exists(dep) for dep in deps]
     for (dep, dep_timestamp) in zip(deps, dep_timestamps):
@@ -295,43 +1110,322 @@ def build(target, options):
             global any_errors
             any_errors = True
             exit(1)
-    if target_timestamp >= 0 and all(dep_timestamp <= target_timestamp for dep_timestamp in dep_timestamps):
-        if all(0 <= get_timestamp_if_exists(dep) <= target_timestamp for dep in d_file_deps):
-            if all(make_db[rule.cwd].get(t) == rule.signature() for t in rule.targets):
-                completed.add(target)
-                return
-
-    # Create the directories that the targets are going to live in, if they don't already exist
-    for t in rule.targets:
-        target_dir = os.path.dirname(t)
-        if not os.path.exists(target_dir):
-            os.makedirs(target_dir)
-
-    if options.parallel:
-        # Enqueue this task to a builder thread -- note that PriorityQueue needs the sense of priority reversed
-        global priority_queue_counter
-        task_queue.put((-rule.priority, priority_queue_counter, rule))
-        priority_queue_counter += 1
-        enqueued.update(rule.targets)
+    if target_timestamp < 0:
+        return False
+    entries = [make_db[rule.cwd].get(t, NO_DB_ENTRY) for t in rule.targets]
+    if options.hash:
+        # Timestamps don't matter in --hash mode, only whether the dependencies' contents match what we built from
+        deps_digest = get_deps_digest(deps + rule.d_file_deps)
+        if not all(entry.deps_digest == deps_digest for entry in entries):
+            return False
     else:
-        # Build the target immediately
-        run_cmd(rule, options)
+        if entries[0].inputs_mtime is not None:
+            # Early cutoff gave some of the targets back older timestamps; they are still up to date with respect to
+            # anything as old as the newest input they were built from
+            target_timestamp = max(target_timestamp, entries[0].inputs_mtime)
+        if not all(dep_timestamp <= target_timestamp for dep_timestamp in dep_timestamps):
+            return False
+        if not all(0 <= get_timestamp_if_exists(dep) <= target_timestamp for dep in rule.d_file_deps):
+            return False
+    return all(entry.signature == rule.signature() for entry in entries)
+
+# Start rules whose dependencies have all completed. Rules that are already up to date complete on the spot (which
+# may make their own dependents ready in turn); the rest are run immediately or handed to the builder threads.
+def start_rules(ready, options):
+    global priority_queue_counter, jobs_outstanding
+    while ready:
+        rule = ready.pop()
+        if is_up_to_date(rule, options):
+            if counting:
+                counters['rules up to date'] += 1
+        else:
+            if counting:
+                counters['rules run'] += 1
+            # Create the directories that the targets are going to live in, if they don't already exist
+            for t in rule.targets:
+                target_dir = os.path.dirname(t)
+                if get_stat(target_dir) is None:
+                    os.makedirs(target_dir, exist_ok=True)
+                    while target_dir and get_stat(target_dir) is None:
+                        refresh_stat(target_dir) # along with any of its parents that makedirs had to create
+                        target_dir = os.path.dirname(target_dir)
+
+            if options.parallel:
+                if remote_pool is not None:
+                    rule.remote_fetch = remote_pool.submit(remote_cache_fetch, options, rule)
+                # Enqueue this task to a builder thread -- note that PriorityQueue needs the sense of priority reversed
+                if trace_events is not None:
+                    trace_queued[rule] = time.perf_counter()
+                with build_cond:
+                    task_queue.put((-rule.priority, priority_queue_counter, rule))
+                    priority_queue_counter += 1
+                    jobs_outstanding += 1
+                continue
+
+            # Build the target immediately
+            run_cmd(rule, options)
+        ready.extend(complete_rule(rule))
+
+# Mark a rule's targets as completed, and return the dependents that were only waiting on this rule
+def complete_rule(rule):
+    global targets_left
+    ready = []
+    with build_cond:
         completed.update(rule.targets)
+        targets_left -= len(rule.targets)
+        for dependent in rule.dependents:
+            dependent.pending -= 1
+            if not dependent.pending:
+                ready.append(dependent)
+        rule.dependents = []
+        build_cond.notify_all()
+    return ready
 
 class BuilderThread(threading.Thread):
-    def __init__(self, options):
+    def __init__(self, options, slot):
         threading.Thread.__init__(self)
         self.options = options
+        self.slot = slot
 
     def run(self):
+        global jobs_outstanding, any_errors
         while not any_errors:
             (priority, counter, rule) = task_queue.get()
             if rule is None:
                 break
-            building.update(rule.targets)
-            run_cmd(rule, self.options)
-            building.difference_update(rule.targets)
-            completed.update(rule.targets)
+            # If run_cmd or start_rules hits an error, it exits this thread, but the main thread still needs a wakeup
+            try:
+                with build_cond:
+                    building.update(rule.targets)
+                    build_cond.notify_all()
+                run_cmd(rule, self.options, self.slot)
+                with build_cond:
+                    building.difference_update(rule.targets)
+                start_rules(complete_rule(rule), self.options)
+            except Exception:
+                any_errors = True # a bug rather than a failed command; don't let the rule look stuck in a cycle
+                raise
+            finally:
+                with build_cond:
+                    jobs_outstanding -= 1
+                    build_cond.notify_all()
+
+# The asyncio build engine: instead of a BuilderThread per job, every job runs in a single event loop on the main
+# thread, so the number of jobs in flight doesn't cost any threads or stacks
+async def run_job_async(rule, options, slot, free_slots):
+    global jobs_outstanding, any_errors
+    try:
+        building.update(rule.targets)
+        await run_cmd_async(rule, options, slot)
+        building.difference_update(rule.targets)
+        start_rules(complete_rule(rule), options)
+    except SystemExit:
+        pass # any_errors is already set; let the other jobs finish, like the BuilderThreads do
+    except Exception:
+        import traceback
+        traceback.print_exc()
+        any_errors = True
+    finally:
+        free_slots.append(slot)
+        with build_cond:
+            jobs_outstanding -= 1
+
+async def run_async_engine(options):
+    import asyncio
+    # On Linux before Python 3.12, asyncio waits for each child process on a thread of its own unless told otherwise
+    if sys.version_info < (3, 12) and hasattr(os, 'pidfd_open') and hasattr(asyncio, 'PidfdChildWatcher'):
+        watcher = asyncio.PidfdChildWatcher()
+        watcher.attach_loop(asyncio.get_running_loop())
+        asyncio.set_child_watcher(watcher)
+
+    running = set()
+    free_slots = list(range(options.jobs, 0, -1)) # numbers for the jobs in flight, like the BuilderThreads have
+    while True:
+        while len(running) < options.jobs and not any_errors:
+            try:
+                (priority, counter, rule) = task_queue.get_nowait()
+            except queue.Empty:
+                break
+            running.add(asyncio.ensure_future(run_job_async(rule, options, free_slots.pop(), free_slots)))
+        timeout = None
+        if progress_line:
+            with build_cond:
+                timeout = refresh_progress()
+        if not running:
+            break
+        (done, running) = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+# make.db is a binary journal: a header, then a record for every target built (or forgotten, when it's about to be
+# rebuilt or turns out to be stale), appended as the build runs so a killed build doesn't lose what it finished. Later
+# records override earlier ones. Once a journal holds too many overridden records, it is rewritten from scratch.
+MAKE_DB_MAGIC = b'make.db\0'
+MAKE_DB_VERSION = 2 # version 1 was the original text make.db, which had no header
+MAKE_DB_HEADER = MAKE_DB_MAGIC + struct.pack('<I', MAKE_DB_VERSION)
+MAKE_DB_RECORD = struct.Struct('<BH') # record type, length of the UTF-8 target path that follows
+MAKE_DB_ENTRY = struct.Struct('<B20s20s20sdd') # after a PUT record's path: which fields are present, then the fields
+MAKE_DB_PUT = 1
+MAKE_DB_DELETE = 2
+
+make_db_lock = threading.Lock()
+make_db_files = {} # dir -> that dir's make.db, open for appending
+make_db_records = {} # dir -> number of records in that dir's make.db, or None if it needs to be rewritten first
+
+def load_make_db(dir):
+    if dir in make_db:
+        return
+    db = make_db[dir] = {}
+    make_db_records[dir] = 0
+    path = '%s/_out/make.db' % dir
+    if not os.path.exists(path):
+        return
+    with open(path, 'rb') as f:
+        header = f.read(len(MAKE_DB_HEADER))
+        if header[:len(MAKE_DB_MAGIC)] != MAKE_DB_MAGIC:
+            load_text_make_db(dir, path)
+            return
+        version = struct.unpack('<I', header[len(MAKE_DB_MAGIC):])[0] if len(header) == len(MAKE_DB_HEADER) else None
+        if version != MAKE_DB_VERSION or os.fstat(f.fileno()).st_size == len(MAKE_DB_HEADER):
+            make_db_records[dir] = None # written by a newer make.py version (so we start over), or empty
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            pos = len(MAKE_DB_HEADER)
+            size = len(buf)
+            records = 0
+            while pos + MAKE_DB_RECORD.size <= size:
+                (kind, length) = MAKE_DB_RECORD.unpack_from(buf, pos)
+                start = pos + MAKE_DB_RECORD.size
+                end = start + length + (MAKE_DB_ENTRY.size if kind == MAKE_DB_PUT else 0)
+                if end > size or kind not in (MAKE_DB_PUT, MAKE_DB_DELETE):
+                    break
+                target = buf[start:start + length].decode()
+                if kind == MAKE_DB_PUT:
+                    (flags, signature, deps_digest, output_digest, inputs_mtime, duration) = \
+                        MAKE_DB_ENTRY.unpack_from(buf, start + length)
+                    db[target] = DbEntry(signature.hex(), deps_digest.hex() if flags & 1 else None,
+                            output_digest.hex() if flags & 2 else None, inputs_mtime if flags & 4 else None,
+                            duration if flags & 8 else None)
+                else:
+                    db.pop(target, None)
+                pos = end
+                records += 1
+            # If the build that wrote this was killed partway through a record, we have to rewrite the file before we can
+            # append to it again
+            make_db_records[dir] = records if pos == size else None
+
+# Read a make.db written by an older version of make.py, which used a text file with a target and its signature on
+# each line
+def load_text_make_db(dir, path):
+    make_db_records[dir] = None
+    with open(path) as f:
+        for line in f:
+            (target, signature) = line.rstrip('\n').rsplit(' ', 1)
+            make_db[dir][target] = DbEntry(signature)
+
+def encode_make_db_record(kind, target, entry=None):
+    target = target.encode()
+    record = MAKE_DB_RECORD.pack(kind, len(target)) + target
+    if kind == MAKE_DB_PUT:
+        flags = (entry.deps_digest is not None) | (entry.output_digest is not None) << 1 | \
+                (entry.inputs_mtime is not None) << 2 | (entry.duration is not None) << 3
+        record += MAKE_DB_ENTRY.pack(flags, bytes.fromhex(entry.signature), bytes.fromhex(entry.deps_digest or ''),
+                bytes.fromhex(entry.output_digest or ''), entry.inputs_mtime or 0.0, entry.duration or 0.0)
+    return record
+
+# Rewrite a dir's make.db with just its live entries. Called with make_db_lock held (or before any builder threads
+# have started).
+def compact_make_db(dir):
+    start = time.perf_counter()
+    if dir in make_db_files:
+        make_db_files.pop(dir).close()
+    out_dir = '%s/_out' % dir
+    if not os.path.exists(out_dir):
+        if not make_db[dir]:
+            make_db_records[dir] = 0
+            return
+        os.makedirs(out_dir)
+    path = '%s/make.db' % out_dir
+    with open(path + '.tmp', 'wb') as f:
+        f.write(MAKE_DB_HEADER)
+        for (target, entry) in make_db[dir].items():
+            f.write(encode_make_db_record(MAKE_DB_PUT, target, entry))
+    os.replace(path + '.tmp', path)
+    make_db_records[dir] = len(make_db[dir])
+    if trace_events is not None: # our callers count the time in the make.db phase
+        add_trace_event("compact '%s/_out/make.db'" % dir, 'phase', start, time.perf_counter())
+
+def make_db_needs_compaction(dir):
+    records = make_db_records[dir]
+    return records is None or records > 2 * len(make_db[dir]) + 1000
+
+def append_make_db_record(dir, record):
+    start = time.perf_counter()
+    if make_db_needs_compaction(dir):
+        compact_make_db(dir) # the rewritten file already reflects this record
+    else:
+        f = make_db_files.get(dir)
+        if f is None:
+            path = '%s/_out/make.db' % dir
+            if not os.path.exists(path):
+                if not os.path.exists('%s/_out' % dir):
+                    os.makedirs('%s/_out' % dir)
+                with open(path, 'wb') as new_f:
+                    new_f.write(MAKE_DB_HEADER)
+            f = make_db_files[dir] = open(path, 'ab')
+        f.write(record)
+        f.flush() # so it survives make.py being killed (though not necessarily the OS crashing)
+        make_db_records[dir] += 1
+    phase_times['make.db'] += time.perf_counter() - start
+
+def make_db_put(dir, target, entry):
+    with make_db_lock:
+        make_db[dir][target] = entry
+        append_make_db_record(dir, encode_make_db_record(MAKE_DB_PUT, target, entry))
+
+def make_db_delete(dir, target):
+    with make_db_lock:
+        del make_db[dir][target]
+        append_make_db_record(dir, encode_make_db_record(MAKE_DB_DELETE, target))
+
+# Called at the end of the build, once the builder threads are done: compact the journals that have grown too much
+def close_make_dbs():
+    for dir in make_db:
+        if make_db_needs_compaction(dir):
+            compact_make_db(dir)
+        if dir in make_db_files:
+            make_db_files.pop(dir).close()
+
+# Run a rules.py file as a new module. Its compiled code is cached in __pycache__ as a hash-based .pyc (see PEP 552),
+# like Python's own for modules imported with --check-hash-based-pycs, so it's only recompiled when its contents change
+# rather than on every run.
+def load_rules_module(pathname, name):
+    with open(pathname, 'rb') as f:
+        source = f.read()
+    source_hash = importlib.util.source_hash(source)
+    cache_path = importlib.util.cache_from_source(pathname)
+    code = None
+    try:
+        with open(cache_path, 'rb') as f:
+            data = f.read()
+        if data[:4] == importlib.util.MAGIC_NUMBER and data[4] & 1 and data[8:16] == source_hash:
+            code = marshal.loads(data[16:])
+    except (OSError, IndexError, ValueError, EOFError, TypeError):
+        pass
+    if code is None:
+        code = compile(source, pathname, 'exec', dont_inherit=True)
+        if not sys.dont_write_bytecode:
+            try:
+                os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+                tmp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+                with open(tmp_path, 'wb') as f:
+                    f.write(importlib.util.MAGIC_NUMBER + struct.pack('<I', 0b11) + source_hash + marshal.dumps(code))
+                os.replace(tmp_path, cache_path)
+            except OSError:
+                pass # e.g. a read-only source tree
+
+    module = importlib.util.module_from_spec(importlib.util.spec_from_file_location(name, pathname))
+    sys.modules[name] = module
+    exec(code, module.__dict__)
+    return module
 
 def parse_rules_py(ctx, options, pathname, visited):
     if pathname in visited:
@@ -339,19 +1433,10 @@ def parse_rules_py(ctx, options, pathname, visited):
     visited.add(pathname)
     if options.verbose:
         print("Parsing '%s'..." % pathname)
-    description = ('.py', 'U', imp.PY_SOURCE)
-    with open(pathname, 'r') as file:
-        rules_py_module = imp.load_module('rules%d' % len(visited), file, pathname, description)
+    rules_py_module = load_rules_module(pathname, 'rules%d' % len(visited))
 
     dir = os.path.dirname(pathname)
-    if dir not in make_db:
-        make_db[dir] = {}
-        path = '%s/_out/make.db' % dir
-        if os.path.exists(path):
-            with open(path) as f:
-                for line in f:
-                    (target, signature) = line.rstrip().rsplit(' ', 1)
-                    make_db[dir][target] = signature
+    load_make_db(dir)
     if hasattr(rules_py_module, 'submakes'):
         for f in rules_py_module.submakes():
             parse_rules_py(ctx, options, normpath(joinpath(dir, f)), visited)
@@ -359,6 +1444,131 @@ def parse_rules_py(ctx, options, pathname, visited):
     if hasattr(rules_py_module, 'rules'):
         rules_py_module.rules(ctx)
 
+# With --parallel-rules, each rules.py file is run in a pool of worker processes, as soon as the file that names it in
+# its submakes() has been run. The workers send back the file's submakes, its rules (in the order it added them), its
+# directory's make.db, and the files of the modules it imported, and the rules are then inserted in the same order
+# parse_rules_py() visits the files in, so that duplicate targets are reported exactly as they would be without it.
+# Each file is run in a fresh module, but not necessarily a fresh process, so like --rules-cache, this is only safe if
+# the rules.py files don't depend on state that other rules.py files leave behind.
+def parse_rules_py_worker(vars, pathname, name):
+    rules.clear()
+    ctx = CollectingContext(vars)
+    modules_before = set(sys.modules)
+    rules_py_module = load_rules_module(pathname, name)
+    dir = os.path.dirname(pathname)
+    submakes = []
+    if hasattr(rules_py_module, 'submakes'):
+        submakes = [normpath(joinpath(dir, f)) for f in rules_py_module.submakes()]
+    ctx.cwd = dir
+    if hasattr(rules_py_module, 'rules'):
+        rules_py_module.rules(ctx)
+    make_db.pop(dir, None)
+    load_make_db(dir)
+    module_files = [getattr(sys.modules[name], '__file__', None) for name in set(sys.modules) - modules_before]
+    return (submakes, ctx.collected, make_db.pop(dir), make_db_records.pop(dir), [f for f in module_files if f])
+
+# Run the rules.py files in parallel, and return the files of the modules they imported
+def parse_rules_parallel(ctx, options, rules_files, visited):
+    results = {}
+    module_files = set()
+    import concurrent.futures
+    with concurrent.futures.ProcessPoolExecutor(options.jobs) as pool:
+        futures = {} # future -> rules.py file
+        submitted = set()
+        def submit(pathname):
+            if pathname in submitted:
+                return
+            submitted.add(pathname)
+            if options.verbose:
+                print("Parsing '%s'..." % pathname)
+            future = pool.submit(parse_rules_py_worker, ctx.vars, pathname, 'rules%d' % len(submitted))
+            futures[future] = pathname
+        for f in rules_files:
+            submit(f)
+        while futures:
+            (done, _) = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                pathname = futures.pop(future)
+                results[pathname] = future.result()
+                module_files.update(results[pathname][4])
+                for f in results[pathname][0]:
+                    submit(f)
+
+    def insert_rules(pathname):
+        if pathname in visited:
+            return
+        visited.add(pathname)
+        (submakes, file_rules, db, records, _) = results[pathname]
+        dir = os.path.dirname(pathname)
+        if dir not in make_db:
+            make_db[dir] = db
+            make_db_records[dir] = records
+        for f in submakes:
+            insert_rules(f)
+        for rule in file_rules:
+            ctx.insert_rule(rule)
+    for f in rules_files:
+        insert_rules(f)
+    return module_files
+
+# Bump this whenever a change to make.py would make previously pickled rule graphs unusable
+RULES_CACHE_VERSION = 2
+
+def get_source_info(path):
+    st = os.stat(path)
+    with open(path, 'rb') as f:
+        digest = hashlib.sha1(f.read()).hexdigest()
+    return (path, st.st_mtime_ns, st.st_size, digest)
+
+# Check whether any of the source files the rules came from changed, returning None if so, or otherwise their source
+# infos with fresh timestamps
+def check_sources(saved_sources):
+    sources = []
+    for (source, mtime, size, digest) in saved_sources:
+        try:
+            st = os.stat(source)
+        except OSError:
+            return None
+        if (st.st_mtime_ns, st.st_size) != (mtime, size):
+            info = get_source_info(source)
+            if info[3] != digest:
+                return None
+            sources.append(info)
+        else:
+            sources.append((source, mtime, size, digest))
+    return sources
+
+# Load the rule graph saved by a previous run with the same rules.py files and variables. The cache is only used if
+# none of its source files (every rules.py visited, the Python modules they imported, and make.py itself) changed; a
+# file whose timestamp changed still counts as unchanged if its contents hash the same. Returns None if the cache
+# can't be used, otherwise the list of source infos with fresh timestamps and whether they differ from the saved ones.
+def load_rules_cache(ctx, rules_files, path):
+    cache = load_pickle(path)
+    if cache is None or cache['key'] != (RULES_CACHE_VERSION, rules_files, sorted(ctx.vars.items())):
+        return None
+    sources = check_sources(cache['sources'])
+    if sources is None:
+        return None
+
+    for rule in cache['rules']:
+        for t in rule.targets:
+            rules[t] = rule
+    for dir in cache['dirs']:
+        load_make_db(dir)
+    return (sources, sources != cache['sources'])
+
+def save_rules_cache(ctx, rules_files, path, sources):
+    unique_rules = list({id(rule): rule for rule in rules.values()}.values())
+    for rule in unique_rules:
+        rule.signature() # the build needs it anyway, and this way the next one doesn't
+    cache = {
+        'key': (RULES_CACHE_VERSION, rules_files, sorted(ctx.vars.items())),
+        'sources': sources,
+        'rules': unique_rules,
+        'dirs': list(make_db),
+    }
+    save_pickle(path, cache)
+
 # returns width-1 for interactive console, or None if stdout is redirected
 def get_usable_columns():
     if os.name == 'nt':
@@ -382,21 +1592,578 @@ def get_usable_columns():
     else:
         return None # XXX maybe we can just use TIOCGWINSZ on *all* Unix platforms?  not sure if any of them don't support it
 
-def propagate_latencies(target, latency):
-    if target not in rules:
+# A rule's priority is the length of the longest chain of rules from it to the targets being built, so the rules on the
+# critical path get started first. Each rule counts for how long it took to run the last few times, in seconds. A rule
+# that has never been built is estimated from its latency argument, in units of the average duration of the rules
+# that have (or of a second, if none have). We walk the graph once to put the rules in topological order, then compute
+# the priorities in a single pass over it, dependents before their dependencies. Returns the length of the critical
+# path, in seconds.
+def propagate_latencies(targets):
+    dep_rules = {} # rule -> the rules for its dependencies, including order-only deps
+    order = [] # post-order: each rule comes after its dependencies
+    for target in targets:
+        rule = rules.get(target)
+        if rule is None or rule in dep_rules:
+            continue
+        dep_rules[rule] = get_dep_rules(rule)
+        stack = [(rule, iter(dep_rules[rule]))]
+        while stack:
+            (rule, deps) = stack[-1]
+            for dep in deps:
+                if dep not in dep_rules:
+                    dep_rules[dep] = get_dep_rules(dep)
+                    stack.append((dep, iter(dep_rules[dep])))
+                    break
+            else:
+                stack.pop()
+                order.append(rule)
+
+    durations = {}
+    for rule in order:
+        rule.priority = 0
+        durations[rule] = make_db[rule.cwd].get(rule.targets[0], NO_DB_ENTRY).duration
+    measured = [x for x in durations.values() if x is not None]
+    latency_unit = sum(measured) / len(measured) if measured else 1.0
+    # With a dependency cycle this isn't quite a topological order, but the build reports the cycle anyway
+    for rule in reversed(order):
+        duration = durations[rule]
+        rule.priority += rule.latency * latency_unit if duration is None else duration
+        for dep in dep_rules[rule]:
+            dep.priority = max(dep.priority, rule.priority)
+    return max([rule.priority for rule in order], default=0)
+
+def get_dep_rules(rule):
+    deps = itertools.chain(rule.dep_paths, rule.order_only_deps)
+    return [rules[dep] for dep in deps if dep in rules]
+
+last_progress_time = 0
+
+# Redraw the progress indicator, unless it was last drawn so recently that a redraw would just flood the console when
+# lots of short jobs are running. In that case, returns how long to wait before calling this again.
+def refresh_progress():
+    global last_progress_time
+    now = time.time()
+    if now - last_progress_time < 0.1:
+        return last_progress_time + 0.1 - now
+    show_progress()
+    last_progress_time = now
+    return None
+
+def show_progress():
+    if targets_left:
+        progress = ' '.join(sorted(x.rsplit('/', 1)[-1] for x in building))
+        progress = 'make.py: %d left, building: %s' % (targets_left, progress)
+    else:
+        progress = ''
+    if len(progress) < usable_columns:
+        pad = usable_columns - len(progress)
+        progress += ' ' * pad # erase old contents
+        progress += '\b' * pad # put cursor back at end of line
+    else:
+        progress = progress[0:usable_columns]
+    stdout_write('\r%s' % progress)
+
+# Reverse dependency index: for every file, the rules that depend on it (including through their .d files, and as an
+# order-only dependency), along with which rules were up to date at the end of the last build. Given the files that
+# changed since then (--changed, or the watcher), only the rules downstream of those are dirty, and the rest of what
+# the last build completed can be taken as up to date without visiting it. It's kept up to date by every build once
+# it exists (though a build without --changed starts over on which rules are up to date), and only trusted if the
+# rules came from the same rules.py sources (see check_sources()).
+RDEPS_INDEX_VERSION = 1
+rdeps_index = None # {'key', 'deps': rule -> its deps, 'dependents': path -> rules, 'built': up-to-date rules}, with
+                   # each rule identified by its first target
+
+def load_rdeps_index(path, key):
+    global rdeps_index
+    if rdeps_index is not None and rdeps_index['key'] == key:
         return
-    rule = rules[target]
-    latency += rule.latency
-    if latency <= rule.priority:
-        return # nothing to do -- we are not increasing the priority of this rule
-    rule.priority = latency # update this rule's latency
+    rdeps_index = load_pickle(path)
+    if rdeps_index is None or rdeps_index['key'] != key:
+        rdeps_index = {'key': key, 'deps': {}, 'dependents': {}, 'built': set()}
+
+# Record the dependencies of the rules visited by the last build, and whether they are up to date now
+def update_rdeps_index():
+    deps_index = rdeps_index['deps']
+    dependents = rdeps_index['dependents']
+    built = rdeps_index['built']
+    for target in visited:
+        rule = rules.get(target)
+        if rule is None or target != rule.targets[0]:
+            continue
+        rule.d_file_deps = get_d_file_deps(rule) # a rule that ran since it was visited wrote a new .d file
+        deps = rule.dep_paths + rule.d_file_deps + rule.order_only_deps
+        old_deps = deps_index.get(target, [])
+        if deps != old_deps:
+            for dep in old_deps:
+                dependents[dep].discard(target)
+            for dep in deps:
+                dependents.setdefault(dep, set()).add(target)
+            deps_index[target] = deps
+        if all(t in completed for t in rule.targets):
+            built.add(target)
+        else:
+            built.discard(target)
+
+# Return the rules that are dirty when the given files change: the rules that build them, and everything downstream
+# of those or of the files themselves
+def get_dirty_rules(changed):
+    dependents = rdeps_index['dependents']
+    dirty = set()
+    stack = list(changed)
+    while stack:
+        path = stack.pop()
+        for target in itertools.chain(dependents.get(path, ()), [path] if path in rules else []):
+            rule = rules.get(target)
+            if rule is not None and rule not in dirty:
+                dirty.add(rule)
+                stack.extend(rule.targets)
+    return dirty
+
+# Run the rules needed to build the targets, starting from whatever is already completed, then save the caches
+def run_build(options, args, out_dir):
+    threads = []
+    if options.parallel and options.engine == 'threads':
+        # Create builder threads
+        for i in range(options.jobs):
+            t = BuilderThread(options, i + 1)
+            t.daemon = True
+            t.start()
+            threads.append(t)
 
-    # Recursively handle the dependencies, including order-only deps
-    deps = [normpath(joinpath(rule.cwd, x)) for x in rule.deps]
-    for dep in itertools.chain(deps, rule.order_only_deps):
-        propagate_latencies(dep, latency)
+    # Do the build, and try to shut down as cleanly as possible if we get a Ctrl-C
+    start = time.perf_counter()
+    try:
+        for target in args:
+            build(target, options)
+        start = trace_phase('graph traversal', start) # with --no-parallel, this includes running the rules
+        if options.parallel and options.engine == 'asyncio':
+            import asyncio
+            asyncio.run(run_async_engine(options))
+            if progress_line:
+                show_progress()
+        elif options.parallel:
+            # Sleep until the builder threads have drained all the work, refreshing the progress indicator as rules
+            # start and complete
+            with build_cond:
+                while jobs_outstanding and not any_errors:
+                    build_cond.wait(refresh_progress() if progress_line else None)
+                if progress_line:
+                    show_progress()
+        if not any_errors:
+            # Everything that could run has run, so any target still not completed is waiting on itself
+            for target in args:
+                if target not in completed:
+                    print("ERROR: dependency cycle involving target '%s'" % target)
+                    exit(1)
+    finally:
+        trace_phase('jobs', start)
+        if threads:
+            # Shut down the system by sending sentinel tokens to all the threads
+            for i in range(options.jobs):
+                task_queue.put((1000000, 0, None)) # lower priority than any real rule
+            for t in threads:
+                t.join()
+
+        # The make.db journals are already up to date, but may need compacting
+        start = time.perf_counter()
+        close_make_dbs()
+        trace_phase('make.db', start)
+        start = time.perf_counter()
+        if remote_pool is not None:
+            remote_pool.shutdown() # finish uploading
+        if options.hash or options.early_cutoff or options.cache_dir:
+            save_hash_cache('%s/hashes.cache' % out_dir)
+        if cache_bytes_stored:
+            trim_cache(options)
+        if d_file_cache_dirty:
+            save_d_file_cache('%s/deps.cache' % out_dir)
+        if rdeps_index is not None:
+            update_rdeps_index()
+            save_pickle('%s/rdeps.cache' % out_dir, rdeps_index)
+        trace_phase('save caches', start)
+        if options.trace:
+            save_trace(options.trace, options.jobs)
+        if options.stats:
+            print_stats()
+
+# Watch mode: after a build, wait for any of the files it read (every dependency, .d file dependency, and rules.py
+# file) or wrote to change, then build again. Only the rules downstream of the changed files are visited again; the
+# rest stay completed from the previous build, and the stat cache is kept, with just the changed files refreshed.
+# make.py's own writes are told apart from edits by comparing each file with the stat results the last build ended
+# with, which already include everything it wrote. Uses inotify where available, and polling elsewhere.
+WATCH_POLL_INTERVAL = 0.5
+WATCH_SETTLE_TIME = 0.05 # editors often save a file in several steps, so wait for the events to stop coming
+INOTIFY_EVENT = struct.Struct('iIII') # wd, mask, cookie, and the length of the name that follows
+INOTIFY_MASK = 0x2 | 0x4 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200 # modify, attrib, close_write, moves, create, delete
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+
+class InotifyWatcher:
+    def __init__(self):
+        import ctypes
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.dirs = {} # watch descriptor -> dir
+
+    # Watch the directories that files live in rather than the files, so that files that are replaced by renaming
+    # another over them, or deleted and created again, stay watched
+    def watch(self, dirs):
+        for dir in dirs - set(self.dirs.values()):
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dir or '/'), INOTIFY_MASK)
+            if wd >= 0: # e.g. a directory that doesn't exist yet; we try again after the next build
+                self.dirs[wd] = dir
+
+    # Wait for events, returning the paths they were for, or None if some events were lost
+    def wait(self, timeout=None):
+        import select
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return set()
+        data = os.read(self.fd, 65536)
+        paths = set()
+        offset = 0
+        while offset < len(data):
+            (wd, mask, _, length) = INOTIFY_EVENT.unpack_from(data, offset)
+            name = data[offset + INOTIFY_EVENT.size:offset + INOTIFY_EVENT.size + length].rstrip(b'\0')
+            offset += INOTIFY_EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                return None
+            if mask & IN_IGNORED: # the directory went away
+                self.dirs.pop(wd, None)
+            elif name and wd in self.dirs:
+                paths.add('%s/%s' % (self.dirs[wd], os.fsdecode(name)))
+        return paths
+
+class PollingWatcher:
+    def watch(self, dirs):
+        pass
 
-def main():
+    def wait(self, timeout=None):
+        time.sleep(WATCH_POLL_INTERVAL if timeout is None else timeout)
+        return None # check everything
+
+def get_watch_key(st):
+    return None if st is None else (st.st_mtime_ns, st.st_size)
+
+# Wait until some of the files in the snapshot differ from it, and return those
+def wait_for_changes(watcher, snapshot):
+    while True:
+        paths = watcher.wait()
+        while paths:
+            more = watcher.wait(WATCH_SETTLE_TIME)
+            if more is None:
+                paths = None
+            elif not more:
+                break
+            else:
+                paths |= more
+        candidates = snapshot if paths is None else [path for path in paths if path in snapshot]
+        changed = []
+        for path in candidates:
+            try:
+                st = os.stat(path)
+            except OSError:
+                st = None
+            if get_watch_key(st) != snapshot[path]:
+                changed.append(path)
+        if changed:
+            return changed
+
+def watch(options, args, out_dir, sources):
+    global trace_events, trace_start, remote_pool
+    try:
+        watcher = InotifyWatcher() if sys.platform.startswith('linux') else PollingWatcher()
+    except (OSError, AttributeError):
+        watcher = PollingWatcher()
+    source_paths = {source for (source, _, _, _) in sources}
+    while True:
+        try:
+            run_build(options, args, out_dir)
+        except SystemExit:
+            pass
+
+        # Everything the builds so far looked at or wrote (see update_rdeps_index()), as of the end of the last one
+        snapshot = {}
+        for rule in {rules[target] for target in rdeps_index['deps'] if target in rules}:
+            for path in itertools.chain(rule.targets, rule.dep_paths, rule.d_file_deps):
+                if path not in snapshot:
+                    snapshot[path] = get_watch_key(get_stat(path))
+        for (path, mtime, size, _) in sources:
+            snapshot[path] = (mtime, size)
+        watcher.watch({path.rpartition('/')[0] for path in snapshot})
+        stdout_write('%s build; watching for changes...\n' % ('Failed' if any_errors else 'Finished'))
+
+        while True:
+            changed = wait_for_changes(watcher, snapshot)
+            for path in changed:
+                refresh_stat(path)
+                snapshot[path] = get_watch_key(get_stat(path))
+            if source_paths.intersection(changed):
+                # A rules.py file (or something one imports) changed, so the rules have to be run again from scratch
+                new_sources = check_sources(sources)
+                if new_sources is None:
+                    stdout_write('A rules.py file changed, restarting...\n')
+                    sys.stdout.flush()
+                    os.execv(sys.executable, [sys.executable] + sys.argv)
+                sources = new_sources
+                changed = [path for path in changed if path not in source_paths]
+            dirty = get_dirty_rules(changed)
+            if dirty:
+                break
+        if options.verbose:
+            print('Changed: %s' % ' '.join(sorted(changed)))
+
+        for rule in dirty:
+            completed.difference_update(rule.targets)
+        reset_scheduler()
+        if options.trace:
+            trace_events = []
+            trace_start = time.perf_counter()
+        if options.remote_cache:
+            import concurrent.futures
+            remote_pool = concurrent.futures.ThreadPoolExecutor()
+
+# Daemon mode: a build server keeps the rules, make.db contents, and .d file and digest caches of a tree in memory
+# between builds, and runs the builds that --daemon clients send it over a Unix domain socket, streaming their output
+# back. This saves starting Python, running the rules.py files, and loading all of that on every build. As with
+# --rules-cache, the rules.py files are run again whenever one of them (or a module one imports) changes. The first
+# --daemon build starts the server in the background; --server runs it in the foreground instead.
+SERVER_FRAME = struct.Struct('<cI') # b'o' and the length of the UTF-8 output that follows, or b'x' and the exit code
+serving = False
+warm_rules = None # the key, sources, and imported modules of the rules currently loaded in the server
+loaded_caches = set() # names of the caches saved in _out that have been loaded already
+make_db_stamps = {} # dir -> (mtime_ns, size) of its make.db at the end of the server's last build
+
+# The socket lives in a directory only this user can get into (under $XDG_RUNTIME_DIR, or else the temp directory),
+# since builds send the server their environment, and print whatever comes back. Anyone else could otherwise create
+# the socket first and listen in.
+def get_server_path(rules_files):
+    import socket, tempfile
+    if not hasattr(socket, 'AF_UNIX'):
+        print('ERROR: the build server needs Unix domain sockets, which this platform lacks')
+        exit(1)
+    dir = '%s/make.py-%d' % (os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir(), os.getuid())
+    try:
+        os.mkdir(dir, 0o700)
+    except FileExistsError:
+        pass
+    st = os.lstat(dir)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        print("ERROR: '%s' must be a directory that only you can access" % dir)
+        exit(1)
+    top_dir = os.path.dirname(rules_files[0])
+    return '%s/%s.sock' % (dir, hashlib.sha1(top_dir.encode()).hexdigest()[:16])
+
+# Check that the other end of a connection to or from the server runs as this user too, where the platform says
+def is_peer_trusted(conn):
+    import socket
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return True # the directory the socket lives in keeps everyone else out anyway
+    (pid, uid, gid) = struct.unpack('3i', conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i')))
+    return uid == os.getuid()
+
+def get_make_db_stamp(dir):
+    try:
+        st = os.stat('%s/_out/make.db' % dir)
+    except FileNotFoundError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+# Forget the rules loaded in the server, along with everything read while loading them
+def forget_rules():
+    global warm_rules
+    rules.clear()
+    make_db.clear()
+    make_db_records.clear()
+    if warm_rules is not None:
+        for name in warm_rules['modules']:
+            sys.modules.pop(name, None) # so that the rules.py files import the current version again
+    warm_rules = None
+
+# Get ready for another build in the server: reset the state of the previous build, and throw out whatever might have
+# changed on disk since then
+def reset_build_state():
+    global stat_generation, remote_pool
+    completed.clear()
+    reset_scheduler()
+    with stat_lock:
+        stat_generation += 1
+        stat_cache.clear()
+        dir_listings.clear()
+    remote_pool = None
+    # Reload any make.db that was written by a make.py run outside the server
+    for dir in list(make_db):
+        if get_make_db_stamp(dir) != make_db_stamps.get(dir):
+            del make_db[dir]
+            load_make_db(dir)
+
+# Reset the scheduler and the bookkeeping of the previous build in this process, keeping what it completed
+def reset_scheduler():
+    global task_queue, priority_queue_counter, any_errors, jobs_outstanding, targets_left
+    global d_file_cache_dirty, trace_events, cache_bytes_stored, remote_cache_failed
+    visited.clear()
+    building.clear()
+    task_queue = queue.PriorityQueue()
+    priority_queue_counter = 0
+    any_errors = False
+    jobs_outstanding = 0
+    targets_left = 0
+    # Racy entries (see get_digest()) were only good for the build they were made in
+    for path in [path for (path, entry) in hash_cache.items() if entry[4]]:
+        del hash_cache[path]
+    for path in [path for (path, entry) in d_file_cache.items() if entry[2]]:
+        del d_file_cache[path]
+    d_file_cache_dirty = False
+    phase_times.clear()
+    phase_times.update(dict.fromkeys(PHASES, 0))
+    counters.clear()
+    trace_events = None
+    trace_queued.clear()
+    cache_bytes_stored = 0
+    remote_cache_failed = False
+
+# Sends a build's output to its client. If the client goes away (e.g. on Ctrl-C), stop the build as soon as the
+# running commands finish, like a Ctrl-C does without the server.
+class ClientOutput:
+    def __init__(self, conn):
+        self.conn = conn
+        self.connected = True
+
+    def write(self, text):
+        global any_errors
+        if self.connected:
+            data = text.encode()
+            try:
+                self.conn.sendall(SERVER_FRAME.pack(b'o', len(data)) + data)
+            except OSError:
+                self.connected = False
+                any_errors = True
+        return len(text)
+
+    def flush(self):
+        pass
+
+def serve_build(conn, request):
+    output = ClientOutput(conn)
+    os.chdir(request['cwd'])
+    os.environ.clear()
+    os.environ.update(request['env'])
+    reset_build_state()
+    (stdout, sys.stdout) = (sys.stdout, output)
+    try:
+        main(request['argv'], request)
+        code = 0
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else 0 if e.code is None else 1
+    except Exception:
+        import traceback
+        traceback.print_exc(file=output)
+        code = 1
+    finally:
+        sys.stdout = stdout
+    for dir in make_db:
+        make_db_stamps[dir] = get_make_db_stamp(dir)
+    return code
+
+def run_server(rules_files):
+    global serving
+    import socket
+    serving = True
+    path = get_server_path(rules_files)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        if stat.S_ISSOCK(os.lstat(path).st_mode):
+            os.unlink(path) # left behind by a server that was killed
+    except FileNotFoundError:
+        pass
+    old_umask = os.umask(0o077) # only this user gets to connect
+    try:
+        server.bind(path)
+    finally:
+        os.umask(old_umask)
+    server.listen()
+    print("Build server for '%s' listening on '%s'" % (os.path.dirname(rules_files[0]), path))
+    sys.stdout.flush()
+    try:
+        while True:
+            (conn, _) = server.accept()
+            with conn:
+                if not is_peer_trusted(conn):
+                    continue
+                try:
+                    request = json.loads(conn.makefile('rb').readline())
+                except ValueError:
+                    continue
+                if request.get('stop'):
+                    break
+                code = serve_build(conn, request)
+                try:
+                    conn.sendall(SERVER_FRAME.pack(b'x', code))
+                except OSError:
+                    pass
+    finally:
+        server.close()
+        os.unlink(path)
+
+def connect_to_server(path):
+    import socket
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        conn.close()
+        return None
+    if not is_peer_trusted(conn):
+        conn.close()
+        print("ERROR: the build server at '%s' is run by another user" % path)
+        exit(1)
+    return conn
+
+# Have the server do a build (starting it if it isn't running yet), printing its output, and return its exit code
+def run_client(rules_files, argv, stdin_text=None):
+    path = get_server_path(rules_files)
+    conn = connect_to_server(path)
+    if conn is None:
+        import subprocess
+        cmd = [sys.executable, os.path.abspath(__file__), '--server']
+        for f in rules_files:
+            cmd += ['-f', f]
+        with open(path + '.log', 'ab') as log:
+            subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=log, stderr=log, start_new_session=True)
+        deadline = time.monotonic() + 10
+        while conn is None:
+            if time.monotonic() > deadline:
+                print("ERROR: couldn't start the build server (see '%s.log')" % path)
+                return 1
+            time.sleep(0.02)
+            conn = connect_to_server(path)
+
+    request = {'argv': argv, 'cwd': os.getcwd(), 'env': dict(os.environ), 'columns': get_usable_columns(),
+               'stdin': stdin_text}
+    with conn:
+        conn.sendall(json.dumps(request).encode() + b'\n')
+        f = conn.makefile('rb')
+        while True:
+            header = f.read(SERVER_FRAME.size)
+            if len(header) < SERVER_FRAME.size:
+                print('ERROR: lost the connection to the build server')
+                return 1
+            (kind, value) = SERVER_FRAME.unpack(header)
+            if kind == b'x':
+                return value
+            sys.stdout.write(f.read(value).decode())
+            sys.stdout.flush()
+
+def stop_server(rules_files):
+    conn = connect_to_server(get_server_path(rules_files))
+    if conn is None:
+        print('No build server is running')
+        return
+    with conn:
+        conn.sendall(json.dumps({'stop': True}).encode() + b'\n')
+
+def main(argv=None, request=None):
     # Parse command line
     parser = OptionParser(usage='%prog [options] target1_path [target2_path ...]')
     parser.add_option('-c', dest='clean', action='store_true', default=False, help='clean before building')
@@ -405,105 +2172,218 @@ def main():
     parser.add_option('-v', dest='verbose', action='store_true', help='print verbose build output')
     parser.add_option('--var', dest='vars', type='str', action='append', default=[], metavar='KEY=VALUE',
             help='option in the form key=value, sets a variable in the ctx.vars dictionary for passing to rules')
+    parser.add_option('--engine', dest='engine', type='choice', choices=['threads', 'asyncio'], default='threads',
+            help='run parallel jobs on one builder thread each ("threads", the default) or all in a single asyncio '
+                 'event loop ("asyncio"), which scales better to very high -j', metavar='ENGINE')
     parser.add_option('--no-parallel', dest='parallel', action='store_false', default=True, help='disable parallel build')
-    (options, args) = parser.parse_args()
+    parser.add_option('--live-output', dest='live_output', action='store_true', default=False,
+            help="print the output of commands as it arrives (prefixed with the name of the rule's target) rather than "
+                 'once each rule is done')
+    parser.add_option('--hash', dest='hash', action='store_true', default=False,
+            help='rebuild targets when the contents of their dependencies change, rather than their timestamps')
+    parser.add_option('--early-cutoff', dest='early_cutoff', action='store_true', default=False,
+            help="don't rebuild the dependents of a target that was rebuilt with identical contents (always on with --hash)")
+    parser.add_option('--parallel-rules', dest='parallel_rules', action='store_true', default=False,
+            help='run the rules.py files in parallel worker processes (only safe if they are independent of each other, '
+                 'e.g. no rules.py file relies on a module variable that another one set)')
+    parser.add_option('--rules-cache', dest='rules_cache', action='store_true', default=False,
+            help='reuse the rules from the previous run when no rules.py file changed (only safe if the rules.py '
+                 'files depend on nothing but their own contents and --var settings)')
+    parser.add_option('--cache-dir', dest='cache_dir', type='str', default=os.environ.get('MAKE_PY_CACHE_DIR'),
+            help='restore the outputs of rules from a build cache in DIR (which several trees can share) when it has '
+                 'them, and save them there otherwise (default: $MAKE_PY_CACHE_DIR, if set)', metavar='DIR')
+    parser.add_option('--cache-size', dest='cache_size', type='str', default='5G',
+            help='evict the least recently used files from the build cache to keep it under SIZE (default: 5G)',
+            metavar='SIZE')
+    parser.add_option('--cache-hardlink', dest='cache_hardlink', action='store_true', default=False,
+            help='with --hash, restore outputs from the build cache as hard links rather than copies (faster, but '
+                 'never modify a target in place then)')
+    parser.add_option('--remote-cache', dest='remote_cache', type='str', default=os.environ.get('MAKE_PY_REMOTE_CACHE'),
+            help='also share the build cache through the HTTP server at URL, e.g. one run with cache_server.py '
+                 '(default: $MAKE_PY_REMOTE_CACHE, if set); without --cache-dir, the local cache lives in _out/cache',
+            metavar='URL')
+    parser.add_option('--stats', dest='stats', action='store_true', default=False,
+            help='print how long each phase of the build took, and counts of files stat\'ed, rules run, etc. (the '
+                 'counts are kept without locking, so with parallel jobs they can come out a little low)')
+    parser.add_option('--trace', dest='trace', type='str', default=None,
+            help='write a trace of the build to FILE, for chrome://tracing or Perfetto', metavar='FILE')
+    parser.add_option('--changed', dest='changed', action='append', default=None, metavar='FILE',
+            help="take FILE (which can be given several times, or as - to read a list of files from stdin, e.g. from "
+                 "'git diff --name-only') to be the only file changed since the last build, so that only the rules "
+                 'downstream of it are visited')
+    parser.add_option('--watch', dest='watch', action='store_true', default=False,
+            help='after building, keep watching the files the build used, and build again whenever one changes')
+    parser.add_option('--daemon', dest='daemon', action='store_true', default=False,
+            help='have a build server that keeps everything loaded in memory between builds do the build, starting '
+                 'one in the background if none is running for this tree yet')
+    parser.add_option('--server', dest='server', action='store_true', default=False,
+            help='run a build server for --daemon builds of this tree in the foreground')
+    parser.add_option('--stop-server', dest='stop_server', action='store_true', default=False,
+            help='stop the build server for this tree')
+    (options, args) = parser.parse_args(argv)
+    options.cache_size = parse_size(options.cache_size)
+    global counting, normpath
+    counting = options.stats
+    normpath = counting_normpath if options.stats else plain_normpath
+    if options.trace:
+        global trace_events, trace_start
+        trace_events = []
+        trace_start = time.perf_counter()
+    if options.cache_dir:
+        options.cache_dir = os.path.abspath(options.cache_dir)
     if options.jobs is None:
-        options.jobs = multiprocessing.cpu_count() # default to one job per CPU
+        options.jobs = os.cpu_count() or 1 # default to one job per CPU
     if options.files is None:
         options.files = ['rules.py'] # default to "-f rules.py"
     cwd = os.getcwd()
     args = [normpath(joinpath(cwd, x)) for x in args]
+    if options.watch and (options.daemon or options.server or serving):
+        print("ERROR: --watch can't be used with the build server")
+        exit(1)
+    if options.daemon or options.server or options.stop_server:
+        rules_files = [normpath(joinpath(cwd, f)) for f in options.files]
+        if options.server:
+            run_server(rules_files)
+        elif options.stop_server:
+            stop_server(rules_files)
+        else:
+            # The server can't read our stdin, so a list of changed files given there has to go along with the request
+            stdin_text = sys.stdin.read() if options.changed is not None and '-' in options.changed else None
+            exit(run_client(rules_files, [arg for arg in (argv or sys.argv[1:]) if arg != '--daemon'], stdin_text))
+        return
 
     # Presumably -v should shut off the progress indicator; supporting it w/ --no-parallel seems like extra work for no gain.
     global progress_line, usable_columns
-    usable_columns = get_usable_columns()
+    usable_columns = get_usable_columns() if request is None else request['columns']
     progress_line = usable_columns is not None and not options.verbose and options.parallel
 
     # Set up rule DB, reading in make.db files as we go
     ctx = BuildContext(options.vars)
-    for f in options.files:
-        parse_rules_py(ctx, options, normpath(joinpath(cwd, f)), visited)
+    rules_files = [normpath(joinpath(cwd, f)) for f in options.files]
+    out_dir = '%s/_out' % os.path.dirname(rules_files[0])
+    rules_cache_path = '%s/rules.cache' % out_dir
+    hash_cache_path = '%s/hashes.cache' % out_dir
+    d_file_cache_path = '%s/deps.cache' % out_dir
+    rdeps_index_path = '%s/rdeps.cache' % out_dir
+    use_rdeps_index = options.changed is not None or options.watch or rdeps_index is not None or \
+            os.path.exists(rdeps_index_path)
+    global cache_base_dir, remote_pool
+    cache_base_dir = os.path.dirname(rules_files[0])
+    if options.remote_cache:
+        if not options.cache_dir:
+            options.cache_dir = '%s/cache' % out_dir
+        import concurrent.futures
+        remote_pool = concurrent.futures.ThreadPoolExecutor()
+    start = time.perf_counter()
+    global warm_rules
+    sources = None
+    save_rules = options.rules_cache
+    if serving:
+        # Keep the rules from the previous build in the server if they came from the same files, none of which changed
+        if warm_rules is not None and warm_rules['key'] == (rules_files, sorted(ctx.vars.items())):
+            sources = check_sources(warm_rules['sources'])
+        if sources is None:
+            forget_rules()
+        else:
+            warm_rules['sources'] = sources
+            save_rules = False
+    if sources is None and options.rules_cache:
+        cached = load_rules_cache(ctx, rules_files, rules_cache_path)
+        if cached is not None:
+            (sources, save_rules) = cached
+            if options.verbose:
+                print("Loaded rules from '%s'" % rules_cache_path)
+    if sources is None:
+        modules_before = set(sys.modules)
+        visited_rules_files = set()
+        module_files = set()
+        if options.parallel_rules:
+            module_files = parse_rules_parallel(ctx, options, rules_files, visited_rules_files)
+        else:
+            for f in rules_files:
+                parse_rules_py(ctx, options, f, visited_rules_files)
+        new_modules = set(sys.modules) - modules_before
+        if options.rules_cache or use_rdeps_index or serving:
+            # Anything a rules.py file imports (directly or not) can affect its rules, so track those files too
+            sources = visited_rules_files | {os.path.abspath(__file__)}
+            module_files.update(getattr(sys.modules[name], '__file__', None) for name in new_modules)
+            for module_file in module_files:
+                if module_file and os.path.isfile(module_file):
+                    sources.add(normpath(os.path.abspath(module_file)))
+            sources = [get_source_info(source) for source in sorted(sources)]
+        if serving:
+            warm_rules = {'key': (rules_files, sorted(ctx.vars.items())), 'sources': sources, 'modules': new_modules}
+    elif serving and warm_rules is None: # loaded from the rules cache
+        warm_rules = {'key': (rules_files, sorted(ctx.vars.items())), 'sources': sources, 'modules': set()}
+    trace_phase('parse rules', start)
     for target in args:
         if target not in rules:
             print("ERROR: no rule to build target '%s'" % target)
             exit(1)
-        propagate_latencies(target, 0)
+    start = time.perf_counter()
+    critical_path = propagate_latencies(args)
+    trace_phase('critical path', start)
+    if options.verbose:
+        print('Critical path: %.2fs' % critical_path)
 
     # Clean up stale targets from previous builds that no longer have rules; also do an explicitly requested clean
+    start = time.perf_counter()
     for (cwd, db) in make_db.items():
         if options.clean:
             dir = '%s/_out' % cwd
             if os.path.exists(dir):
                 stdout_write("Cleaning '%s'...\n" % dir)
+                import shutil
                 shutil.rmtree(dir)
             db.clear()
-        for (target, signature) in list(db.items()):
+            make_db_records[cwd] = 0
+        for target in list(db):
             if target not in rules:
                 if os.path.exists(target):
                     print("Deleting stale target '%s'..." % target)
                     remove_path(cwd, target)
-                del db[target]
+                make_db_delete(cwd, target)
+    trace_phase('stale cleanup', start)
 
-    if options.parallel:
-        # Create builder threads
-        threads = []
-        for i in range(options.jobs):
-            t = BuilderThread(options)
-            t.daemon = True
-            t.start()
-            threads.append(t)
+    start = time.perf_counter()
+    if (options.hash or options.early_cutoff or options.cache_dir) and 'hashes' not in loaded_caches:
+        hash_cache.update(load_pickle(hash_cache_path) or {})
+        loaded_caches.add('hashes')
+    if 'deps' not in loaded_caches:
+        d_file_cache.update(load_pickle(d_file_cache_path) or {})
+        loaded_caches.add('deps')
+    if use_rdeps_index:
+        load_rdeps_index(rdeps_index_path, (RDEPS_INDEX_VERSION, rules_files, sorted(ctx.vars.items()),
+                                            [(source, digest) for (source, _, _, digest) in sources]))
+        if options.clean or options.changed is None:
+            # Without --changed, files may have changed anywhere since the last build, so only what this build visits
+            # is known to be up to date afterwards
+            rdeps_index['built'].clear()
+    trace_phase('load caches', start)
 
-    # Do the build, and try to shut down as cleanly as possible if we get a Ctrl-C
-    try:
-        if options.parallel:
-            # Enqueue work to the builders
-            while True:
-                visited.clear()
-                for target in args:
-                    build(target, options)
-
-                # Show progress update and exit if done, otherwise sleep to prevent burning 100% of CPU
-                # Be careful about iterating over data structures being edited concurrently by the BuilderThreads
-                if any_errors:
-                    break
-                if progress_line:
-                    incomplete_count = sum(1 for x in (visited - completed) if x in rules)
-                    if incomplete_count:
-                        progress = ' '.join(sorted(x.rsplit('/', 1)[-1] for x in set(building)))
-                        progress = 'make.py: %d left, building: %s' % (incomplete_count, progress)
-                    else:
-                        progress = ''
-                    if len(progress) < usable_columns:
-                        pad = usable_columns - len(progress)
-                        progress += ' ' * pad # erase old contents
-                        progress += '\b' * pad # put cursor back at end of line
-                    else:
-                        progress = progress[0:usable_columns]
-                    stdout_write('\r%s' % progress)
-                if all(target in completed for target in args):
-                    break
-                time.sleep(0.1)
-        else:
-            for target in args:
-                build(target, options)
-    finally:
-        if options.parallel:
-            # Shut down the system by sending sentinel tokens to all the threads
-            for i in range(options.jobs):
-                task_queue.put((1000000, 0, None)) # lower priority than any real rule
-            for t in threads:
-                t.join()
+    if options.changed is not None:
+        changed = []
+        for f in options.changed:
+            if f == '-':
+                changed += (sys.stdin.read() if request is None else request['stdin'] or '').split()
+            else:
+                changed.append(f)
+        dirty = get_dirty_rules(normpath(joinpath(os.getcwd(), f)) for f in changed)
+        if options.verbose:
+            print('%d rules dirty' % len(dirty))
+        # Everything else that was up to date after the last build still is
+        for target in rdeps_index['built']:
+            rule = rules.get(target)
+            if rule is not None and rule not in dirty:
+                completed.update(rule.targets)
 
-        # Write out the final make.db files
-        # XXX May want to do this "occasionally" as the build is running?  (not too often to avoid a perf hit, but often
-        # enough to avoid data loss)
-        for (cwd, db) in make_db.items():
-            if not os.path.exists('%s/_out' % cwd):
-                os.mkdir('%s/_out' % cwd)
-            with open('%s/_out/make.db' % cwd, 'w') as f:
-                for (target, signature) in db.items():
-                    f.write('%s %s\n' % (target, signature))
+    # Save the rules for next time (after the clean above, since that wipes out the _out directory it lives in)
+    if save_rules or (options.rules_cache and options.clean):
+        save_rules_cache(ctx, rules_files, rules_cache_path, sources)
 
+    if options.watch:
+        watch(options, args, out_dir, sources) # never returns
+    run_build(options, args, out_dir)
     if any_errors:
         exit(1)
 
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+import os
+import sys
+import tempfile
+import traceback
+
+import make
+
+PASSES = FAILS = 0
+
+def test(name, fn):
+    global PASSES, FAILS
+
+    # Check test name against filters
+    if len(sys.argv) > 1 and not any(arg in name for arg in sys.argv[1:]):
+        return
+
+    with tempfile.TemporaryDirectory() as dir:
+        reset_make_db()
+        try:
+            fn(dir)
+            PASSES += 1
+        except Exception:
+            print('Test %r failed:' % name)
+            traceback.print_exc()
+            FAILS += 1
+        finally:
+            make.close_make_dbs()
+
+def reset_make_db():
+    make.close_make_dbs()
+    make.make_db.clear()
+    make.make_db_records.clear()
+
+def reload_make_db(dir):
+    reset_make_db()
+    make.load_make_db(dir)
+    return make.make_db[dir]
+
+def check_eq(actual, expected):
+    if actual != expected:
+        raise AssertionError('expected %r, got %r' % (expected, actual))
+
+ENTRIES = {
+    'a.o': make.DbEntry('11' * 20),
+    'b.o': make.DbEntry('22' * 20, '33' * 20, '44' * 20, 1234.5, 0.25),
+    'sub/c.o': make.DbEntry('55' * 20, None, '66' * 20, None, 3.0),
+}
+
+def fill_make_db(dir):
+    make.load_make_db(dir)
+    for (target, entry) in ENTRIES.items():
+        make.make_db_put(dir, target, entry)
+
+def test_round_trip(dir):
+    fill_make_db(dir)
+    make.make_db_put(dir, 'a.o', ENTRIES['b.o'])
+    make.make_db_delete(dir, 'sub/c.o')
+    make.close_make_dbs()
+    expected = {'a.o': ENTRIES['b.o'], 'b.o': ENTRIES['b.o']}
+    check_eq(reload_make_db(dir), expected)
+    check_eq(make.make_db_records[dir], 5) # the journal is appended to, not rewritten
+
+    # Appending after a reload keeps the earlier records
+    make.make_db_put(dir, 'd.o', ENTRIES['a.o'])
+    make.close_make_dbs()
+    check_eq(reload_make_db(dir), {**expected, 'd.o': ENTRIES['a.o']})
+
+def test_compaction(dir):
+    make.load_make_db(dir)
+    for i in range(1100):
+        make.make_db_put(dir, 'a.o', make.DbEntry('%040x' % i))
+    make.close_make_dbs()
+    check_eq(reload_make_db(dir), {'a.o': make.DbEntry('%040x' % 1099)})
+    check_eq(make.make_db_records[dir] < 1100, True)
+
+def test_torn_record(dir):
+    fill_make_db(dir)
+    make.close_make_dbs()
+    path = '%s/_out/make.db' % dir
+    size = os.path.getsize(path)
+    os.truncate(path, size - 5) # as if the build was killed while writing the last record
+    db = reload_make_db(dir)
+    check_eq(db, {'a.o': ENTRIES['a.o'], 'b.o': ENTRIES['b.o']})
+    check_eq(make.make_db_records[dir], None)
+
+    # The next record rewrites the file rather than appending after the partial record
+    make.make_db_put(dir, 'sub/c.o', ENTRIES['sub/c.o'])
+    make.close_make_dbs()
+    check_eq(reload_make_db(dir), ENTRIES)
+    check_eq(make.make_db_records[dir], len(ENTRIES))
+    check_eq(os.path.getsize(path), size)
+
+def test_text_make_db(dir):
+    os.mkdir('%s/_out' % dir)
+    with open('%s/_out/make.db' % dir, 'w') as f:
+        f.write('a.o %s\n' % ('11' * 20))
+        f.write('dir with spaces/b.o %s\n' % ('22' * 20))
+    check_eq(reload_make_db(dir), {'a.o': ENTRIES['a.o'], 'dir with spaces/b.o': make.DbEntry('22' * 20)})
+    check_eq(make.make_db_records[dir], None)
+
+    make.make_db_put(dir, 'b.o', ENTRIES['b.o'])
+    make.close_make_dbs()
+    with open('%s/_out/make.db' % dir, 'rb') as f:
+        check_eq(f.read(len(make.MAKE_DB_HEADER)), make.MAKE_DB_HEADER)
+    check_eq(len(reload_make_db(dir)), 3)
+
+def main():
+    test('make.db round trip', test_round_trip)
+    test('make.db compaction', test_compaction)
+    test('make.db torn last record', test_torn_record)
+    test('make.db text format', test_text_make_db)
+    print('%s/%s tests passed.' % (PASSES, PASSES + FAILS))
+
+if __name__ == '__main__':
+    main()